@@ -30,8 +30,25 @@ from urllib.parse import urlencode
 import http.cookiejar
 import shelve
 from contextlib import contextmanager
-from collections import defaultdict
+from collections import defaultdict, OrderedDict, deque
 import random
+import os
+import threading
+from urllib.parse import urlsplit, urljoin, parse_qs
+import http.client
+import http.server
+import zlib
+import codecs
+import asyncio
+import argparse
+import hashlib
+import sqlite3
+import atexit
+import queue
+import select
+import multiprocessing
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed, wait, FIRST_COMPLETED
 
 try:
     from credentials import *  # NOQA
@@ -65,23 +82,138 @@ def p(data, end='\n', color_seed=None):
         + color + data + '\033[39m', end=end)
 
 
+# an entry on the html modlog page
+_html_entry = re.compile(
+    r'''<div class="entry"><span>(\[[^\]]*\]\[[^\]]*\])</span> (.*?)</div>'''
+    r'''(?=\s*(?:<div class="entry">|</body>|$))''', re.S)
+
+
+class ActionLog(object):
+    """The moderation log.
+
+    Entries are appended to `path` as JSON lines by a background thread, so logging never waits
+    on the disk, and the file is rotated once it's bigger than `max_bytes`.  The html page at
+    `html_path` is rendered from the newest `html_entries` entries by render(), which writes a temp
+    file and renames it over the old page so it's never half written.  If there's no JSON log
+    yet, the entries of an existing page (from before there was one) are copied into it first."""
+
+    def __init__(self, path, html_path, max_bytes=5 * 1024 * 1024, backups=3, html_entries=1000):
+        self.path = path
+        self.html_path = html_path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        if not os.path.exists(self.path):
+            self._import_html()
+        self.recent = deque(self._tail(html_entries), maxlen=html_entries)
+        self.dirty = False
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name='actionlog', daemon=True)
+        self.thread.start()
+
+    def _tail(self, count):
+        try:
+            with open(self.path) as f:
+                lines = deque(f, maxlen=count)
+        except OSError:
+            return []
+        entries = []
+        for line in lines:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # a line cut short by a crash
+                pass
+        return entries
+
+    def _import_html(self):
+        try:
+            with open(self.html_path) as f:
+                page = f.read()
+        except OSError:
+            return
+        entries = []
+        # newest first, and not always one per line
+        for stamp, text in _html_entry.findall(page):
+            try:
+                when = time.mktime(time.strptime(stamp, '[%y/%m/%d][%H:%M:%S]'))
+            except ValueError:
+                continue
+            entries.append({'time': when, 'text': text})
+        if entries:
+            with open(self.path, 'w') as f:
+                for entry in reversed(entries):
+                    f.write(json.dumps(entry) + '\n')
+
+    def log(self, text):
+        entry = {'time': time.time(), 'text': text}
+        self.recent.append(entry)
+        self.dirty = True
+        self.queue.put(entry)
+
+    def _rotate(self):
+        for n in range(self.backups - 1, 0, -1):
+            if os.path.exists('{}.{}'.format(self.path, n)):
+                os.replace('{}.{}'.format(self.path, n), '{}.{}'.format(self.path, n + 1))
+        os.replace(self.path, self.path + '.1')
+
+    def _run(self):
+        while True:
+            entries = [self.queue.get()]
+            # write whatever else piled up in the same go
+            while not self.queue.empty():
+                entries.append(self.queue.get())
+            try:
+                with open(self.path, 'a') as f:
+                    for entry in entries:
+                        f.write(json.dumps(entry) + '\n')
+                    size = f.tell()
+                if size > self.max_bytes:
+                    self._rotate()
+            except OSError as e:
+                p('Could not write to {}: {}'.format(self.path, e))
+            for entry in entries:
+                self.queue.task_done()
+
+    def flush(self):
+        """Blocks until everything logged so far is on disk."""
+        self.queue.join()
+
+    def render(self, force=False):
+        """Writes the html page if anything was logged since the last time."""
+        if not self.dirty and not force:
+            return
+        self.dirty = False
+        log_start = (
+            "<html><head><link rel=\"stylesheet\" type=\"text/css\" href=\"style.css\" /><titl"
+            "e>{username} modlog</title></head><body>".format(username=USERNAME))
+        log_end = "</body>"
+        entries = [
+            "<div class=\"entry\"><span>{time}</span> {data}</div>".format(
+                time=time.strftime('[%y/%m/%d][%H:%M:%S]', time.localtime(i['time'])),
+                data=i['text'])
+            for i in reversed(list(self.recent))]
+        tmp = self.html_path + '.tmp'
+        with open(tmp, 'w') as l:
+            l.write(log_start + '\n'.join(entries) + log_end)
+        os.replace(tmp, self.html_path)
+
+
+_action_log = None
+_action_log_lock = threading.Lock()
+
+
+def action_log():
+    """The ActionLog for LOGFILE, started on first use."""
+    global _action_log
+    with _action_log_lock:
+        if _action_log is None:
+            _action_log = ActionLog(LOGFILE + '.jsonl', LOGFILE)
+            atexit.register(_action_log.flush)
+        return _action_log
+
+
 def logToDisk(log_text):
-    log_start = (
-        "<html><head><link rel=\"stylesheet\" type=\"text/css\" href=\"style.css\" /><titl"
-        "e>{username} modlog</title></head><body>".format(username=USERNAME))
-    log_end = "</body>"
-    entry_base = "<div class=\"entry\"><span>{time}</span> {data}</div>".format(
-        time=time.strftime('[%y/%m/%d][%H:%M:%S]'), data=log_text)
-    with open(LOGFILE) as l:
-        log = l.read().strip()
-    log = log[len(log_start):-len(log_end)]
-    split_log = log.split('\n')
-    if len(split_log) < 1000:
-        log = '\n'.join(split_log)
-    else:
-        log = '\n'.join(split_log[1:])
-    with open(LOGFILE, 'w') as l:
-        l.write(log_start + entry_base + log + log_end)
+    action_log().log(log_text)
 
 
 def sigint_handler(signal, frame):
@@ -92,11 +224,8 @@ def sigint_handler(signal, frame):
 
 def mojangStatus():
     '''Returns the status indicator for /r/Minecraft's sidebar'''
-    opener = urllib.request.build_opener()
-    opener.addheaders = [('User-agent', 'moderator-bot.py v2')]
     try:
-        with opener.open(STATUS_JSON) as w:
-            status = json.loads(w.read().decode('utf-8'))['report']
+        status = HTTPClient().request(STATUS_JSON).json()['report']
     except:
         return None
     text = []
@@ -116,48 +245,887 @@ def mojangStatus():
     return '\n{}\n'.format(sidebar_text)
 
 
-class Database(object):
-    '''Handles reading and writing from a shelve 'database'.'''
-    def __init__(self, path):
-        self.path = path
+# requests allowed per period (seconds) for each api we talk to.  Hosts are matched on their last
+# two labels, so www.reddit.com and reddit.com share a budget.
+RATE_LIMITS = {
+    'reddit.com': (30, 60),
+    'imgur.com': (50, 60),
+    'youtube.com': (30, 60),
+    None: (30, 60)}
+
+
+class RateLimiter(object):
+    """Token bucket rate limiter.
+
+    Requests can burst up to `capacity`, after which they're let through at capacity / period per
+    second.  If the server tells us how much budget is left (X-Ratelimit-Remaining and
+    X-Ratelimit-Reset, like reddit does) we trust that over our own count."""
+
+    def __init__(self, capacity, period):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """Blocks until a request is allowed and returns how long we waited."""
+        waited = 0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self.blocked_until:
+                    wait = self.blocked_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                else:
+                    wait = (1 - self.tokens) / self.rate
+            # sleep without the lock, so update() isn't held up, and look again after
+            time.sleep(wait)
+            waited += wait
+
+    def update(self, headers):
+        """Syncs the bucket with the rate limit headers of a response, if there are any."""
+        try:
+            remaining = float(headers['X-Ratelimit-Remaining'])
+            reset = float(headers['X-Ratelimit-Reset'])
+        except (KeyError, TypeError, ValueError):
+            return
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens = min(self.tokens, remaining)
+            if remaining < 1:
+                self.blocked_until = now + reset
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def rate_limiter(url):
+    """Returns the shared RateLimiter for the host in url."""
+    host = urlsplit(url).hostname or ''
+    host = '.'.join(host.split('.')[-2:])
+    with _rate_limiters_lock:
+        if host not in _rate_limiters:
+            _rate_limiters[host] = RateLimiter(*RATE_LIMITS.get(host, RATE_LIMITS[None]))
+        return _rate_limiters[host]
+
+
+def endpoint_name(url):
+    """The path of url with ids and usernames (anything with a digit or a capital in it) replaced
+    by *, so requests to the same api endpoint are counted together."""
+    return re.sub(r'''/[^/]*[\dA-Z][^/]*''', '/*', urlsplit(url).path) or '/'
+
+
+class Metrics(object):
+    """Counters and wall time histograms for the hot paths, labelled by filter, host, endpoint
+    and so on.  render() writes them out in the Prometheus text format, and summary() sums up
+    one cycle in a line."""
+
+    # histogram bucket bounds, in seconds
+    BUCKETS = (.001, .005, .01, .05, .1, .5, 1, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = defaultdict(float)
+        self.histograms = {}
+
+    def _key(self, name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            self.counters[self._key(name, labels)] += value
+
+    def observe(self, name, seconds, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = [[0] * len(self.BUCKETS), 0, 0]
+            histogram = self.histograms[key]
+            for n, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    histogram[0][n] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
 
     @contextmanager
-    def open(self):
-        s = shelve.open(self.path, writeback=True)
+    def timer(self, name, **labels):
+        start = time.perf_counter()
         try:
-            yield s
+            yield
         finally:
-            s.close()
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def snapshot(self):
+        """{(name, labels): value} for counters and {(name, labels): (sum, count)} for
+        histograms, to diff against later."""
+        with self.lock:
+            return dict(self.counters), {k: (v[1], v[2]) for k, v in self.histograms.items()}
+
+    def render(self):
+        def labels(pairs, **extra):
+            pairs = list(pairs) + sorted(extra.items())
+            if not pairs:
+                return ''
+            return '{' + ','.join(
+                '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                for k, v in pairs) + '}'
+        lines = []
+        with self.lock:
+            typed = set()
+            for (name, pairs), value in sorted(self.counters.items()):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append('# TYPE {} counter'.format(name))
+                lines.append('{}{} {}'.format(name, labels(pairs), value))
+            for (name, pairs), (buckets, total, count) in sorted(self.histograms.items()):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append('# TYPE {} histogram'.format(name))
+                for bound, n in zip(self.BUCKETS, buckets):
+                    lines.append('{}_bucket{} {}'.format(name, labels(pairs, le=bound), n))
+                lines.append('{}_bucket{} {}'.format(name, labels(pairs, le='+Inf'), count))
+                lines.append('{}_sum{} {}'.format(name, labels(pairs), total))
+                lines.append('{}_count{} {}'.format(name, labels(pairs), count))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self, since):
+        """One line on what happened since the snapshot `since`: where the time went, the cache
+        hit ratio and how long we waited on rate limits."""
+        counters, histograms = self.snapshot()
+        old_counters, old_histograms = since
+
+        def spent(name, label):
+            output = defaultdict(lambda: [0, 0])
+            for key, (total, count) in histograms.items():
+                if key[0] == name:
+                    old_total, old_count = old_histograms.get(key, (0, 0))
+                    output[dict(key[1])[label]][0] += total - old_total
+                    output[dict(key[1])[label]][1] += count - old_count
+            return sorted(output.items(), key=lambda i: -i[1][0])
+
+        def counted(name, **match):
+            return sum(
+                value - old_counters.get(key, 0) for key, value in counters.items()
+                if key[0] == name and all(dict(key[1]).get(k) == v for k, v in match.items()))
+
+        parts = []
+        slowest = ['{} {:.2f}s'.format(i, t) for i, (t, n) in spent('moderator_filter_seconds',
+                                                                   'filter')[:3] if t >= .01]
+        if slowest:
+            parts.append('filters: ' + ', '.join(slowest))
+        slowest = ['{} {:.2f}s/{}'.format(i, t, n) for i, (t, n) in spent(
+            'moderator_http_seconds', 'endpoint')[:3] if t >= .01]
+        if slowest:
+            parts.append('endpoints: ' + ', '.join(slowest))
+        hits = counted('moderator_cache_requests_total', result='hit')
+        lookups = counted('moderator_cache_requests_total')
+        if lookups:
+            parts.append('cache {:.0%} of {}'.format(hits / lookups, int(lookups)))
+        waited = counted('moderator_ratelimit_wait_seconds_total')
+        if waited >= .01:
+            parts.append('rate limited {:.1f}s'.format(waited))
+        return '; '.join(parts)
+
+    def serve(self, port, host='127.0.0.1'):
+        """Serves render() at http://host:port/metrics from a background thread."""
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+        return server
+
+
+metrics = Metrics()
 
 
-def cache_url(function):
+# seconds before we give up on a socket
+HTTP_TIMEOUT = 30
+USER_AGENT = 'moderator-bot.py v2'
+
+
+class ConnectionPool(object):
+    """Keeps idle keep-alive connections around, per (scheme, host, port), so we don't pay for a
+    new TCP (and TLS) handshake on every request."""
+
+    def __init__(self, max_idle=4, timeout=HTTP_TIMEOUT, chunk_size=64 * 1024):
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.idle = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def _connect(self, scheme, host, port):
+        if scheme == 'https':
+            return http.client.HTTPSConnection(host, port, timeout=self.timeout)
+        return http.client.HTTPConnection(host, port, timeout=self.timeout)
+
+    def _idle(self, key):
+        """Returns an idle connection to key that still looks open, or None."""
+        while True:
+            with self.lock:
+                if not self.idle[key]:
+                    return None
+                conn = self.idle[key].pop()
+            # an idle connection has nothing to read, unless the server has hung up on it
+            try:
+                readable = conn.sock is None or select.select([conn.sock], [], [], 0)[0]
+            except (OSError, ValueError):
+                readable = True
+            if not readable:
+                return conn
+            conn.close()
+
+    def _start(self, method, url, body, headers):
+        """Sends the request and reads the response headers.  Returns (key, connection,
+        response)."""
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        conn = self._idle(key)
+        reused = conn is not None
+        while True:
+            if conn is None:
+                conn = self._connect(*key)
+            sent = False
+            try:
+                conn.request(method, path, body=body, headers=headers or {})
+                sent = True
+                return key, conn, conn.getresponse()
+            except (http.client.HTTPException, OSError) as e:
+                conn.close()
+                conn = None
+                # the server may have closed an idle connection on us (_idle catches most of
+                # those), try once with a fresh one.  Once a POST has gone out it may have been
+                # acted on (a comment posted, a user banned), so those aren't sent twice.
+                if not reused or (sent and method != 'GET'):
+                    raise urllib.error.URLError(e)
+                reused = False
+
+    def _release(self, key, conn, resp):
+        """Keeps conn for the next request to the same host, once resp has been read."""
+        if resp.will_close:
+            conn.close()
+            return
+        with self.lock:
+            if len(self.idle[key]) < self.max_idle:
+                self.idle[key].append(conn)
+                return
+        conn.close()
+
+    def send(self, method, url, body=None, headers=None):
+        """Sends a single request and returns (status, reason, headers, raw body)."""
+        key, conn, resp = self._start(method, url, body, headers)
+        try:
+            data = resp.read()
+        except (http.client.HTTPException, OSError) as e:
+            conn.close()
+            raise urllib.error.URLError(e)
+        self._release(key, conn, resp)
+        return resp.status, resp.reason, resp.msg, data
+
+    def open(self, method, url, body=None, headers=None):
+        """Like send, but returns an iterator over the raw body as it comes in instead of the
+        whole body.  The connection goes back to the pool once the body is read to the end."""
+        key, conn, resp = self._start(method, url, body, headers)
+
+        def chunks():
+            finished = False
+            try:
+                while True:
+                    chunk = resp.read1(self.chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+                finished = True
+            except (http.client.HTTPException, OSError) as e:
+                raise urllib.error.URLError(e)
+            finally:
+                if finished:
+                    # read1 leaves the response open when the body ends on a Content-Length, and
+                    # the connection won't take another request until it's closed
+                    resp.close()
+                    self._release(key, conn, resp)
+                else:
+                    conn.close()
+        return resp.status, resp.reason, resp.msg, chunks()
+
+
+connection_pool = ConnectionPool()
+
+
+class Response(object):
+    def __init__(self, url, status, headers, data):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.data = data
+
+    def info(self):
+        # for http.cookiejar
+        return self.headers
+
+    def text(self):
+        return self.data.decode('utf-8')
+
+    def json(self):
+        return json.loads(self.text())
+
+
+class HTTPClient(object):
+    """Everything that talks to the network goes through one of these.  It shares the keep-alive
+    connection pool, asks for compressed responses, follows redirects, keeps cookies if given a
+    jar, and takes a token from the host's rate limiter before every request.  HTTP errors are
+    raised as urllib.error.HTTPError, same as urllib would."""
+
+    def __init__(self, headers=None, cookiejar=None, pool=None):
+        self.headers = {'User-Agent': USER_AGENT, 'Accept-Encoding': 'gzip, deflate'}
+        self.headers.update(headers or {})
+        self.cookiejar = cookiejar
+        self.pool = pool
+
+    def _decode(self, headers, chunks):
+        """Decompresses the body as it comes in."""
+        encoding = (headers.get('Content-Encoding') or '').lower()
+        if encoding == 'gzip':
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            decompressor = zlib.decompressobj()
+        else:
+            yield from chunks
+            return
+        first = True
+        for chunk in chunks:
+            try:
+                data = decompressor.decompress(chunk)
+            except zlib.error:
+                if not first or encoding != 'deflate':
+                    raise
+                # some servers send raw deflate without the zlib header
+                decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                data = decompressor.decompress(chunk)
+            first = False
+            if data:
+                yield data
+        data = decompressor.flush()
+        if data:
+            yield data
+
+    def _timed(self, chunks, start, host, endpoint):
+        """Passes chunks through, and records how long the whole request took once they're
+        all read."""
+        try:
+            yield from chunks
+        finally:
+            metrics.observe(
+                'moderator_http_seconds', time.perf_counter() - start, host=host,
+                endpoint=endpoint)
+
+    def request(self, url, body=None, headers=None):
+        """Sends a GET, or a POST if there is a body, and returns a Response."""
+        response, chunks = self._open(url, body, headers)
+        response.data = b''.join(chunks)
+        return response
+
+    def stream(self, url, headers=None):
+        """Sends a GET and returns the Response, without its data, and an iterator over the
+        decompressed body as it comes in.  HTTP errors are raised before anything is read."""
+        return self._open(url, None, headers)
+
+    def _open(self, url, body, headers):
+        pool = self.pool or connection_pool
+        method = 'GET' if body is None else 'POST'
+        for redirect in range(6):
+            request_headers = dict(self.headers)
+            request_headers.update(headers or {})
+            if body is not None:
+                request_headers['Content-Type'] = 'application/x-www-form-urlencoded'
+            if self.cookiejar is not None:
+                cookie_request = urllib.request.Request(url, headers=request_headers)
+                self.cookiejar.add_cookie_header(cookie_request)
+                request_headers.update(cookie_request.unredirected_hdrs)
+            limiter = rate_limiter(url)
+            host = urlsplit(url).hostname or ''
+            endpoint = endpoint_name(url)
+            metrics.inc('moderator_ratelimit_wait_seconds_total', limiter.acquire(), host=host)
+            start = time.perf_counter()
+            if hasattr(pool, 'open'):
+                status, reason, response_headers, chunks = pool.open(
+                    method, url, body, request_headers)
+            else:
+                # stand-ins for the pool (see ReplayTransport) only need send
+                status, reason, response_headers, data = pool.send(
+                    method, url, body, request_headers)
+                chunks = iter([data])
+            chunks = self._timed(chunks, start, host, endpoint)
+            metrics.inc(
+                'moderator_http_requests_total', host=host, endpoint=endpoint, status=status)
+            limiter.update(response_headers)
+            response = Response(url, status, response_headers, None)
+            if self.cookiejar is not None:
+                self.cookiejar.extract_cookies(response, cookie_request)
+            if status in (301, 302, 303, 307, 308) or status >= 400:
+                # read it all so the connection can be used again
+                for i in chunks:
+                    pass
+            if status in (301, 302, 303, 307, 308) and 'Location' in response_headers:
+                url = urljoin(url, response_headers['Location'])
+                if status in (301, 302, 303):
+                    method, body = 'GET', None
+                continue
+            if status >= 400:
+                raise urllib.error.HTTPError(url, status, reason, response_headers, None)
+            return response, self._decode(response_headers, chunks)
+        raise urllib.error.HTTPError(url, status, 'Too many redirects', response_headers, None)
+
+
+class ModerationStore(object):
+    """Moderation state, kept in sqlite.
+
+    `submissions` holds the ids of submissions we've dealt with (kept for `retention` seconds),
+    `users` what we know about each user, `profiles` the video authors we found on their profile
+    and `bans` every ban we've made, so a restart doesn't ban anyone twice.  All are keyed on
+    their primary key, so lookups don't slow down as they grow; the bans are also kept in memory
+    in a set, loaded at startup, since they're checked for every caught item.  Bans are written
+    as soon as they're made; other writes are buffered and upserted in one transaction by
+    commit(), which the main loop calls once per cycle, and which also runs on exit.  The first
+    time it's opened, whatever is in the old shelve database at `legacy_path` is copied over."""
+
+    def __init__(self, path, retention=60 * 60 * 24 * 90, legacy_path=None):
+        self.retention = retention
+        self.lock = threading.RLock()
+        self.pending_submissions = {}
+        self.pending_users = {}
+        self.pending_profiles = {}
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS submissions (id TEXT PRIMARY KEY, processed REAL)')
+            self.conn.execute(
+                'CREATE INDEX IF NOT EXISTS submissions_processed ON submissions (processed)')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS users (name TEXT PRIMARY KEY, checked_last REAL, '
+                'warned INTEGER, banned INTEGER)')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS profiles (name TEXT PRIMARY KEY, items TEXT)')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS bans (author TEXT, subreddit TEXT, filter TEXT, '
+                'banned REAL, PRIMARY KEY (author, subreddit))')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self.bans = set(self.conn.execute('SELECT author, subreddit FROM bans'))
+        if legacy_path:
+            self._migrate(legacy_path)
+        atexit.register(self.commit)
+
+    def _migrate(self, legacy_path):
+        if self.conn.execute("SELECT 1 FROM meta WHERE key = 'migrated'").fetchone():
+            return
+        try:
+            shelf = shelve.open(legacy_path, flag='r')
+        except Exception:
+            shelf = None
+        if shelf is not None:
+            p('Copying the old database at {} into sqlite...'.format(legacy_path))
+            with shelf:
+                now = time.time()
+                for i in shelf.get('submissions', []):
+                    self.pending_submissions[i] = now
+                for name, user in shelf.get('users', {}).items():
+                    self.pending_users[name] = dict(user)
+        self.commit()
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('migrated', ?)", (time.time(),))
+
+    def has_submission(self, submission_id):
+        with self.lock:
+            if submission_id in self.pending_submissions:
+                return True
+            return self.conn.execute(
+                'SELECT 1 FROM submissions WHERE id = ?', (submission_id,)).fetchone() is not None
+
+    def add_submission(self, submission_id):
+        with self.lock:
+            self.pending_submissions[submission_id] = time.time()
+
+    def get_user(self, name):
+        """Returns a copy of what we know about a user."""
+        with self.lock:
+            if name in self.pending_users:
+                return dict(self.pending_users[name])
+            row = self.conn.execute(
+                'SELECT checked_last, warned, banned FROM users WHERE name = ?',
+                (name,)).fetchone()
+        if row is None:
+            return {'checked_last': 0, 'warned': False, 'banned': False}
+        return {'checked_last': row[0], 'warned': bool(row[1]), 'banned': bool(row[2])}
+
+    def save_user(self, name, user):
+        with self.lock:
+            self.pending_users[name] = dict(user)
+
+    def get_profile(self, name):
+        """Returns {fullname: video author or ''} for the submissions of a user we've already
+        looked at."""
+        with self.lock:
+            if name in self.pending_profiles:
+                return dict(self.pending_profiles[name])
+            row = self.conn.execute(
+                'SELECT items FROM profiles WHERE name = ?', (name,)).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def save_profile(self, name, items):
+        with self.lock:
+            self.pending_profiles[name] = dict(items)
+
+    def is_banned(self, author, subreddit):
+        return (author, subreddit) in self.bans
+
+    def add_ban(self, author, subreddit, filter_name):
+        """Records a ban reddit has accepted.  Unlike everything else this is written straight
+        away, so a ban is never forgotten (and made again) because we died mid-cycle."""
+        with self.lock:
+            self.bans.add((author, subreddit))
+            with self.conn:
+                self.conn.execute(
+                    'INSERT OR REPLACE INTO bans (author, subreddit, filter, banned) '
+                    'VALUES (?, ?, ?, ?)', (author, subreddit, filter_name, time.time()))
+
+    def commit(self):
+        """Writes out everything buffered since the last commit and drops old submissions."""
+        with self.lock:
+            submissions = list(self.pending_submissions.items())
+            profiles = [(name, json.dumps(i)) for name, i in self.pending_profiles.items()]
+            users = [
+                (name, i['checked_last'], int(bool(i['warned'])), int(bool(i['banned'])))
+                for name, i in self.pending_users.items()]
+            with self.conn:
+                self.conn.executemany(
+                    'INSERT OR REPLACE INTO submissions (id, processed) VALUES (?, ?)',
+                    submissions)
+                self.conn.executemany(
+                    'INSERT OR REPLACE INTO users (name, checked_last, warned, banned) '
+                    'VALUES (?, ?, ?, ?)', users)
+                self.conn.executemany(
+                    'INSERT OR REPLACE INTO profiles (name, items) VALUES (?, ?)', profiles)
+                self.conn.execute(
+                    'DELETE FROM submissions WHERE processed < ?',
+                    (time.time() - self.retention,))
+            self.pending_submissions.clear()
+            self.pending_users.clear()
+            self.pending_profiles.clear()
+
+
+class SeenItems(object):
+    '''Bounded set of recently processed fullnames.
+
+    Lookups are O(1).  Entries expire `ttl` seconds after they were last seen and the oldest are
+    evicted once `max_size` is reached, so memory stays capped no matter how long we run.  The set
+    is saved to `path` so a restart doesn't run every filter over the last few listings again.'''
+    def __init__(self, path=None, ttl=60 * 60 * 24 * 3, max_size=20000):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.dirty = False
+        # listings are fetched from several threads in --async mode
+        self.lock = threading.RLock()
+        self.load()
+
+    def __contains__(self, name):
+        with self.lock:
+            if name not in self.items:
+                return False
+            now = time.time()
+            if now - self.items[name] > self.ttl:
+                del self.items[name]
+                self.dirty = True
+                return False
+            # still showing up in a listing, keep it around
+            self.items[name] = now
+            self.items.move_to_end(name)
+            return True
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, name):
+        with self.lock:
+            self.items[name] = time.time()
+            self.items.move_to_end(name)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+            self.dirty = True
+
+    def expire(self):
+        """Drops everything older than the ttl.  Items are kept in last-seen order, so we only
+        have to look at the front."""
+        cutoff = time.time() - self.ttl
+        with self.lock:
+            while self.items:
+                name, seen = next(iter(self.items.items()))
+                if seen > cutoff:
+                    break
+                del self.items[name]
+                self.dirty = True
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                items = json.load(f)
+        except (OSError, ValueError):
+            p('Could not read {}, starting with an empty seen list.'.format(self.path))
+            return
+        for name, seen in sorted(items, key=lambda i: i[1]):
+            self.items[name] = seen
+        self.expire()
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+        self.dirty = False
+
+    def save(self):
+        """Writes the set to disk if it changed.  We write to a temp file and rename it over the
+        old one so a crash mid-write can't leave us with a truncated file."""
+        if not self.path or not self.dirty:
+            return
+        self.expire()
+        with self.lock:
+            items = list(self.items.items())
+            self.dirty = False
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(items, f)
+        os.replace(tmp, self.path)
+
+
+class UrlCache(object):
+    """On-disk cache of url responses, one sqlite row per url.
+
+    Every entry has its own expiry time, so failed lookups can be cached (as None) for less time
+    than good ones.  Expired rows are deleted in bulk every `expire_every` seconds, and once there
+    are more than `max_entries` the least recently used go too.  The most recently used
+    `hot_size` entries are also kept in memory, so repeat lookups don't touch the disk at all."""
+
+    # returned by get() when there's nothing cached, since None is a valid (negative) entry
+    MISS = object()
+
+    def __init__(self, path, max_entries=50000, hot_size=500, expire_every=60 * 10):
+        self.max_entries = max_entries
+        self.hot_size = hot_size
+        self.expire_every = expire_every
+        self.hot = OrderedDict()
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        columns = [i[1] for i in self.conn.execute('PRAGMA table_info(cache)')]
+        if columns and 'expires' not in columns:
+            # made by an older version, it's only a cache so start over
+            self.conn.execute('DROP TABLE cache')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS cache '
+            '(url TEXT PRIMARY KEY, expires REAL, accessed REAL, data TEXT)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)')
+        self.last_expire = 0
+
+    def _remember(self, url, expires, data):
+        self.hot[url] = (expires, data)
+        self.hot.move_to_end(url)
+        while len(self.hot) > self.hot_size:
+            self.hot.popitem(last=False)
+
+    def get(self, url):
+        """Returns the cached data for url, or UrlCache.MISS if we don't have it or it's
+        expired."""
+        now = time.time()
+        with self.lock:
+            self._maybe_expire(now)
+            if url in self.hot:
+                expires, data = self.hot[url]
+                if now < expires:
+                    self.hot.move_to_end(url)
+                    return data
+                del self.hot[url]
+            row = self.conn.execute(
+                'SELECT expires, data FROM cache WHERE url = ? AND expires > ?',
+                (url, now)).fetchone()
+            if row is None:
+                return self.MISS
+            self.conn.execute('UPDATE cache SET accessed = ? WHERE url = ?', (now, url))
+            data = json.loads(row[1])
+            self._remember(url, row[0], data)
+            return data
+
+    def set(self, url, data, ttl):
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO cache (url, expires, accessed, data) VALUES (?, ?, ?, ?)',
+                (url, now + ttl, now, json.dumps(data)))
+            self._remember(url, now + ttl, data)
+
+    def _maybe_expire(self, now):
+        if now - self.last_expire < self.expire_every:
+            return
+        self.last_expire = now
+        self.conn.execute('DELETE FROM cache WHERE expires <= ?', (now,))
+        self.conn.execute(
+            'DELETE FROM cache WHERE url IN (SELECT url FROM cache ORDER BY accessed DESC '
+            'LIMIT -1 OFFSET ?)', (self.max_entries,))
+
+
+_url_cache = None
+_url_cache_lock = threading.Lock()
+
+
+def url_cache():
+    """The UrlCache shared by everything decorated with cache_url, opened on first use."""
+    global _url_cache
+    with _url_cache_lock:
+        if _url_cache is None:
+            _url_cache = UrlCache(CACHEFILE + '.sqlite')
+        return _url_cache
+
+
+def cache_url(function=None, ttl=60 * 60 * 48, negative_ttl=60 * 15):
     """Url caching decorator.  For decorating class functions that take a single url as an arg"""
-    """and return the response."""
+    """and return the response.  Falsy responses are cached as None for negative_ttl seconds,"""
+    """and callers asking for a url that's already being fetched wait for that fetch instead of"""
+    """making their own.  Use as @cache_url or @cache_url(ttl=..., negative_ttl=...)."""
 
-    #expire time (seconds)
-    expire_after = 60 * 60 * 48
+    if function is None:
+        return lambda function: cache_url(function, ttl, negative_ttl)
 
-    db = Database(CACHEFILE)
+    in_flight = {}
+    in_flight_lock = threading.Lock()
+    name = function.__qualname__
 
     def new_function(self, url):
-        with db.open() as d:
-            if not 'cache' in d:
-                d['cache'] = dict()
-            if url in d['cache']:
-                output = d['cache'][url]
-                expire_time = output['time'] + expire_after
-                if time.time() < expire_time:
-                    return output['data']
-                else:
-                    del d['cache'][url]
-            output = function(self, url)
-            if output:
-                to_cache = {'time': time.time(), 'data': output}
-                d['cache'][url] = to_cache
-                return output
+        cache = url_cache()
+        output = cache.get(url)
+        if output is not UrlCache.MISS:
+            metrics.inc('moderator_cache_requests_total', function=name, result='hit')
+            return output
+        with in_flight_lock:
+            fetch = in_flight.get(url)
+            if fetch is None:
+                fetch = in_flight[url] = Future()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            metrics.inc('moderator_cache_requests_total', function=name, result='coalesced')
+            return fetch.result()
+        metrics.inc('moderator_cache_requests_total', function=name, result='miss')
+        try:
+            output = function(self, url) or None
+            cache.set(url, output, ttl if output else negative_ttl)
+            fetch.set_result(output)
+            return output
+        except BaseException as e:
+            fetch.set_exception(e)
+            raise
+        finally:
+            with in_flight_lock:
+                del in_flight[url]
     return new_function
 
 
+# the parts of a listing item anything looks at; the rest (the *_html copies, media embeds,
+# awards...) is dropped as soon as the item is parsed
+LISTING_FIELDS = frozenset((
+    'title', 'selftext', 'url', 'domain', 'body', 'author', 'name', 'id', 'link_id', 'subreddit',
+    'banned_by', 'approved_by', 'num_reports', 'link_flair_css_class'))
+
+_children_start = re.compile(r'''"children"\s*:\s*\[''')
+
+
+def iter_listing(chunks, fields=LISTING_FIELDS):
+    """Yields the children of a listing, as {'kind': ..., 'data': {only `fields`}}, as soon as
+    each one has come in.  `chunks` is the raw json body, in pieces, as it arrives."""
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    # where the next child starts, once we're in the children array
+    pos = None
+    # a child that isn't all here yet is tried again once the buffer has doubled, so a huge one
+    # isn't parsed over and over
+    wait_for = 0
+    finished = False
+    chunks = iter(chunks)
+    while not finished:
+        chunk = next(chunks, None)
+        if chunk is not None:
+            buffer += text.decode(chunk)
+            if len(buffer) < wait_for:
+                continue
+        if pos is None:
+            match = _children_start.search(buffer)
+            if match is None:
+                if chunk is None:
+                    return
+                continue
+            pos = match.end()
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos == len(buffer):
+                break
+            if buffer[pos] == ']':
+                finished = True
+                break
+            try:
+                child, end = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                wait_for = None
+                break
+            data = child.get('data', {})
+            yield {'kind': child.get('kind'), 'data': {k: data[k] for k in fields if k in data}}
+            pos = end
+            wait_for = 0
+        buffer = buffer[pos:]
+        pos = 0
+        if wait_for is None:
+            # the child that isn't all here is all that's left in the buffer now
+            wait_for = len(buffer) * 2
+        if chunk is None:
+            # the body ended before the array did
+            return
+    # read the rest so the connection can be used again
+    for chunk in chunks:
+        pass
+
+
 class Reddit(object):
     """Base class to perform the tasks of a redditor."""
 
@@ -165,19 +1133,19 @@ class Reddit(object):
         self.username = username
         self.password = password
         self.cj = http.cookiejar.CookieJar()
-        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(self.cj))
-        self.opener.addheaders = [('User-agent', 'moderator-bot.py v2')]
+        self.client = HTTPClient(cookiejar=self.cj)
         self._login()
 
-    def _request(self, url, body=None):
+    def _request(self, url, body=None, raise_errors=False):
         if body is not None:
             body = urlencode(body).encode('utf-8')
         try:
-            with self.opener.open(url, data=body) as w:
-                time.sleep(2)
-                return json.loads(w.read().decode('utf-8'))
-        except urllib.error.HTTPError:
-            # This should at least help for times when reddit derps up when we request a listing
+            return self.client.request(url, body).json()
+        except urllib.error.URLError:
+            if raise_errors:
+                raise
+            # This should at least help for times when reddit derps up when we request a listing,
+            # or the network does
             return dict()
 
     def _login(self):
@@ -186,7 +1154,7 @@ class Reddit(object):
         resp = self._request('http://www.reddit.com/api/login', body)
         self.modhash = resp['json']['data']['modhash']
 
-    def post(self, url, body):
+    def post(self, url, body, raise_errors=False):
         """Sends a POST to the url and returns the json as a dict."""
 
         if 'api_type' not in body:
@@ -194,28 +1162,70 @@ class Reddit(object):
 
         body['uh'] = self.modhash
 
-        return self._request(url, body)
+        return self._request(url, body, raise_errors)
 
-    def get(self, url):
+    def _act(self, url, body):
+        """POST for moderation actions, which raises if reddit refused it."""
+        response = self.post(url, body, raise_errors=True)
+        errors = response.get('json', {}).get('errors')
+        if errors:
+            raise ValueError('reddit said {}'.format(errors))
+        return response
+
+    def get(self, url, raise_errors=False):
         """Sends a GET to the url and returns the json as a dict."""
         if '.json' not in url:
             url += '.json'
-        return self._request(url)
-
-    def nuke(self, post, action):
-        '''Remove/hide/comment.'''
-        if action == 'remove' or action == 'spammed':
-            remove = {
-                'r': post['subreddit'], 'id': post['name'], 'executed': action}
-            if action == 'remove':
-                remove['spam'] = 'false'
-            self.post('http://www.reddit.com/api/remove', remove)
-        if action == 'report':
-            report = {'id': post['name']}
-            self.post('http://www.reddit.com/api/report', report)
-        if 'title' in post:
-            hide = {'id': post['name']}
-            self.post('http://www.reddit.com/api/hide', hide)
+        return self._request(url, raise_errors=raise_errors)
+
+    def listing(self, url):
+        """Yields the children of a listing as they're read, with only LISTING_FIELDS in their
+        data (see iter_listing).  Yields nothing if reddit sends back an error."""
+        if '.json' not in url:
+            url += '.json'
+        try:
+            response, chunks = self.client.stream(url)
+        except urllib.error.HTTPError:
+            return
+        yield from iter_listing(chunks)
+
+    def fetch(self, url, headers=None):
+        """Sends a GET with extra headers and returns the Response, or None on an HTTP error.
+        Used for conditional requests, where we need the status and headers too."""
+        if '.json' not in url:
+            url += '.json'
+        try:
+            return self.client.request(url, headers=headers)
+        except urllib.error.HTTPError:
+            return None
+
+    def remove(self, post, action):
+        """Removes post, as spam if action is 'spammed'."""
+        remove = {'r': post['subreddit'], 'id': post['name'], 'executed': action}
+        if action == 'remove':
+            remove['spam'] = 'false'
+        self._act('http://www.reddit.com/api/remove', remove)
+
+    def report(self, post):
+        self._act('http://www.reddit.com/api/report', {'id': post['name']})
+
+    def hide(self, post):
+        self._act('http://www.reddit.com/api/hide', {'id': post['name']})
+
+    def comment(self, post, text):
+        """Replies to post and returns the id of the new comment."""
+        comment = {'thing_id': post['name'], 'text': text}
+        response = self._act('http://www.reddit.com/api/comment', comment)
+        return response['json']['data']['things'][0]['data']['id']
+
+    def distinguish(self, comment_id):
+        distinguish = {'id': comment_id, 'executed': 'distinguishing...'}
+        self._act('http://www.reddit.com/api/distinguish/yes', distinguish)
+
+    def ban(self, username, subreddit):
+        body = {
+            'action': 'add', 'type': 'banned', 'name': username, 'id': '#banned', 'r': subreddit}
+        self._act('http://www.reddit.com/api/friend', body)
 
     def rts(self, username, tag='', subreddit=None, check_age=True):
         """Checks the account age of a user and rts' them if they are less than a day old."""
@@ -255,41 +1265,191 @@ class Reddit(object):
         self.post('http://www.reddit.com/r/{}/api/wiki/edit'.format(subreddit), body)
 
 
+class PollSchedule(object):
+    """Decides when a listing is read next.
+
+    We keep a moving average of how many new items turn up per second, and wait about as long as
+    it takes for `target` of them to pile up: seconds apart during a raid, up to `max_interval`
+    when nothing is happening.  A backlog (more than a page of new items) means reading again as
+    soon as allowed.  The wait counts from when the poll started, so a slow cycle eats into it
+    instead of adding to it."""
+
+    def __init__(self, min_interval=5, max_interval=600, target=10, interval=60, smoothing=.3):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.target = target
+        self.smoothing = smoothing
+        self.interval = interval
+        self.rate = None
+        self.last = None
+        self.next = 0
+
+    def due(self, now):
+        return now >= self.next
+
+    def update(self, started, count, backlog=False):
+        """Records a poll that started at `started` (time.monotonic()) and found count items."""
+        if self.last is not None:
+            rate = count / max(started - self.last, 1)
+            # speed up straight away when things pick up, slow down gradually
+            if self.rate is None or rate > self.rate:
+                self.rate = rate
+            else:
+                self.rate = self.smoothing * rate + (1 - self.smoothing) * self.rate
+        self.last = started
+        if backlog:
+            interval = self.min_interval
+        elif self.rate is None:
+            interval = self.interval
+        elif self.rate:
+            interval = self.target / self.rate
+        else:
+            interval = self.max_interval
+        self.interval = min(self.max_interval, max(self.min_interval, interval))
+        self.next = started + self.interval
+
+
+class ListingCursor(object):
+    """Incrementally reads a listing.
+
+    We remember the newest fullname we've seen and ask reddit only for things newer than it with
+    `before=`.  If a full page comes back there's a backlog, and if nothing comes back the cursor
+    may have been removed (reddit returns nothing for before= then), so either way we walk down
+    from the top of the listing with `after=` until we reach the cursor or something else this
+    cursor handed out recently.  Listings where items come and go (the modqueue) set use_before
+    to False and always have their whole first page read; new_items drops the ones we've
+    already looked at.  Each listing is read on its own PollSchedule."""
+
+    def __init__(self, reddit, url, use_before=True, limit=100, max_pages=10, schedule=None):
+        self.reddit = reddit
+        self.url = url
+        self.schedule = schedule or PollSchedule()
+        # whether the last fetch found more than a page of new items
+        self.backlog = False
+        self.use_before = use_before
+        self.limit = limit
+        self.max_pages = max_pages
+        self.newest = None
+        # the fullnames this cursor handed out lately, newest last, so a walk can stop at them if
+        # the cursor itself is gone
+        self.recent = OrderedDict()
+        self.max_recent = limit * max_pages
+
+    def _page(self, **params):
+        """Yields the children of one page as they're read, see Reddit.listing."""
+        params['limit'] = self.limit
+        url = self.url + ('&' if '?' in self.url else '?') + urlencode(params)
+        return self.reddit.listing(url)
+
+    def fetch(self):
+        """Returns the listing children newer than the last ones this cursor handed out, newest
+        first."""
+        return list(self.stream())
+
+    def stream(self):
+        """Like fetch, but yields the children as they come off the wire."""
+        started = time.monotonic()
+        count = 0
+        for item in self._fetch():
+            # the schedule goes by what's new, not by what's still sitting in the modqueue
+            if item['data']['name'] not in self.recent:
+                count += 1
+            yield item
+        self.schedule.update(started, count, self.backlog)
+
+    def _remember(self, name):
+        self.recent[name] = True
+        self.recent.move_to_end(name)
+        while len(self.recent) > self.max_recent:
+            self.recent.popitem(last=False)
+
+    def _fetch(self):
+        self.backlog = False
+        if self.use_before and self.newest:
+            # a page that turns out to be full is read again from the top below, so nothing is
+            # handed out until we know it isn't
+            children = list(self._page(before=self.newest))
+            if 0 < len(children) < self.limit:
+                self.newest = children[0]['data']['name']
+                for item in reversed(children):
+                    self._remember(item['data']['name'])
+                yield from children
+                return
+
+        # no cursor yet, a backlog, or before= came back empty: read down from the top.  On the
+        # very first poll we only look at one page rather than chewing through the whole backlog.
+        # We only stop at what this cursor has handed out: the bot's seen-set is shared by all
+        # the listings, so something seen through the modqueue says nothing about what's below
+        # it here.
+        newest = None
+        after = None
+        # pages can shift while we read them, so the same item may turn up twice
+        handed_out = OrderedDict()
+        walk = self.use_before and self.newest
+        for page in range(self.max_pages if walk else 1):
+            count = 0
+            caught_up = False
+            for item in self._page(after=after) if after else self._page():
+                # the rest of the page is still read, so the connection can be used again
+                count += 1
+                name = item['data']['name']
+                after = name
+                if newest is None:
+                    newest = name
+                if caught_up or name in handed_out:
+                    continue
+                if walk and (name == self.newest or name in self.recent):
+                    caught_up = True
+                    continue
+                handed_out[name] = True
+                yield item
+            if caught_up or count < self.limit:
+                break
+            self.backlog = True
+        # oldest first, so the newest are the last to be forgotten
+        for name in reversed(handed_out):
+            self._remember(name)
+        if newest:
+            self.newest = newest
+
+
 class Imgur(object):
-    def __init__(self, client_id):
-        self.opener = urllib.request.build_opener()
-        self.opener.addheaders = [
-            ('User-agent', 'moderator-bot.py v2'),
-            ('Authorization', 'Client-id {}'.format(client_id))]
+    def __init__(self, client_id, workers=4):
+        self.client = HTTPClient({'Authorization': 'Client-id {}'.format(client_id)})
+        self.executor = ThreadPoolExecutor(max_workers=workers)
 
     @cache_url
     def _request(self, url):
         try:
-            with self.opener.open(url) as w:
-                time.sleep(2)
-                imgur = w.read().decode('utf-8')
-                imgur = json.loads(imgur)['data']
-        except:
+            imgur = self.client.request(url).json()['data']
+        except urllib.error.HTTPError as e:
+            # a 404 just means it isn't that kind of id, but let the enrichment queue retry
+            # server errors, same as it does when the network fails
+            if e.code >= 500:
+                raise
+            return None
+        except (ValueError, KeyError):
             return None
 
         if not 'error' in imgur:
             return imgur
 
     def _get_ids(self, url):
-        """Turns a url into a set of imgur ids"""
+        """Turns a url into a list of imgur ids, in the order they appear"""
         url = url.split('#')[0]
         if url.endswith('/'):
             url = url[:-1]
         if url.endswith('/all'):
             url = url[:-4]
         url = re.split(r'''(?i)imgur.com(?:/gallery|/a)?/''', url)[1]
-        ids = set(re.split(r''',|&''', url))
+        ids = list(OrderedDict.fromkeys(re.split(r''',|&''', url)))
         return ids
 
     def _get(self, imgur_id, use_gallery, force_single=False):
         """Returns a list containing a dicts of titles/descriptions for images and galleries."""
-        """We try the imgur_id as a album first, and if that fails we assume it's an individual"""
-        """image.  If force_single is True, we skip the initial album try."""
+        """Album ids are 5 characters and image ids are 7, so we try whichever the id looks like"""
+        """first and fall back to the other.  If force_single is True, we only try it as an"""
+        """image."""
 
         p("Checking imgur id {}...".format(imgur_id), end="", color_seed=imgur_id)
 
@@ -302,19 +1462,22 @@ class Imgur(object):
                 'album': 'https://api.imgur.com/3/album/{}.json',
                 'image': 'https://api.imgur.com/3/image/{}.json'}
 
-        if not force_single:
-            output = list()
-            imgur = self._request(urls['album'].format(imgur_id))
-            if imgur:
-                output.append({'title': imgur['title'], 'description': imgur['description']})
+        if force_single:
+            kinds = ('image',)
+        elif len(imgur_id) == 7:
+            kinds = ('image', 'album')
+        else:
+            kinds = ('album', 'image')
+
+        for kind in kinds:
+            imgur = self._request(urls[kind].format(imgur_id))
+            if not imgur:
+                continue
+            output = [{'title': imgur['title'], 'description': imgur['description']}]
+            if kind == 'album':
                 for i in imgur['images']:
                     output.append({'title': i['title'], 'description': i['description']})
-                return output
-
-        imgur = self._request(urls['image'].format(imgur_id))
-
-        if imgur:
-            return [{'title': imgur['title'], 'description': imgur['description']}]
+            return output
 
     def get(self, url):
         """Returns a list of dicts of the title/description of images/galleries"""
@@ -327,36 +1490,35 @@ class Imgur(object):
         else:
             use_g = False
 
-        # we can assume that if we have a list, that they're all individual images
-        if len(ids) > 1:
-            for i in ids:
-                imgur = self._get(i, use_g)
+        # look the ids up at the same time, map() hands the results back in the same order
+        with metrics.timer('moderator_lookup_seconds', lookup='Imgur.get'):
+            for imgur in self.executor.map(lambda i: self._get(i, use_g), ids):
                 if imgur:
                     output.extend(imgur)
-        else:
-            imgur = self._get(ids.pop(), use_g)
-            if imgur:
-                output = imgur
 
         return output
 
 
+YOUTUBE_DOMAINS = ('m.youtube.com', 'youtube.com', 'youtu.be')
+
+
 class Youtube(object):
     def __init__(self):
-        self.opener = urllib.request.build_opener()
-        self.opener.addheaders = [('User-agent', 'moderator-bot.py v2')]
+        self.client = HTTPClient()
 
-    #@cache_url
+    @cache_url
     def _request(self, url):
         try:
-            with self.opener.open(url) as w:
-                youtube = w.read().decode('utf-8')
-                yt_json = json.loads(youtube)
-        except:
+            yt_json = self.client.request(url).json()
+        except urllib.error.HTTPError as e:
+            # server errors and network errors are retried by the enrichment queue
+            if e.code >= 500:
+                raise
+            return None
+        except ValueError:
             return None
 
         if not 'errors' in yt_json:
-            time.sleep(2)
             return yt_json['entry']
 
     def _get_id(self, url):
@@ -380,12 +1542,14 @@ class Youtube(object):
 
         yt_id = self._get_id(url)
 
-        if yt_id:
-            return self._request(urls['video'].format(yt_id))
-        else:
-            username = re.findall(r'''(?i)\.com\/(?:user\/|channel\/)?(.*?)(?:\/|\?|$)''', url)
-            if username:
-                return self._request(urls['profile'].format(username[0]))
+        with metrics.timer('moderator_lookup_seconds', lookup='Youtube.get'):
+            if yt_id:
+                return self._request(urls['video'].format(yt_id))
+            else:
+                username = re.findall(
+                    r'''(?i)\.com\/(?:user\/|channel\/)?(.*?)(?:\/|\?|$)''', url)
+                if username:
+                    return self._request(urls['profile'].format(username[0]))
 
     def get_author(self, url):
         """Returns the author id of the youtube url"""
@@ -404,10 +1568,62 @@ class Youtube(object):
                 return {'title': title, 'description': description}
 
 
+class RegexIndex(object):
+    """Runs the regexes of all the filters over a post up front, one field at a time.
+
+    re.I is what makes most of our patterns slow: it turns off re's literal prefix search and
+    folds every character of the text for every pattern.  Instead we lowercase each field once and
+    run a case-sensitive copy of every pattern over it.  For patterns written in lowercase that
+    matches a superset of what the original would, so a filter that didn't fire in the scan can't
+    match and skips its own search, and one that did fire runs its real regex to get the details
+    (see Filter._may_match).  Most posts don't fire anything."""
+
+    def __init__(self, filters):
+        self.fields = defaultdict(list)
+        for f in filters:
+            if f.regex is None:
+                continue
+            # \S, \W and friends are fine, any other uppercase would break on lowercased text
+            pattern = re.sub(r'''\\[A-Z]''', '', f.regex.pattern)
+            if pattern != pattern.lower():
+                raise ValueError('{} has uppercase in its regex'.format(type(f).__name__))
+            folded = re.compile(f.regex.pattern)
+            for field in f.regex_fields:
+                self.fields[field].append((f, folded))
+
+    def scan(self, post):
+        """Returns {field: set of filters that matched} for every indexed field in post."""
+        output = {}
+        for field, patterns in self.fields.items():
+            text = post.get(field)
+            if not isinstance(text, str):
+                continue
+            text = text.lower()
+            output[field] = {f for f, regex in patterns if regex.search(text)}
+        return output
+
+
+class Verdict(object):
+    """What a filter wants done about a post it caught."""
+    def __init__(self, filter_name, action='remove', comment='', log_text='', tag='', ban=False,
+                 nuke=True, report_subreddit=None, check_age=True):
+        self.filter_name = filter_name
+        self.action = action
+        self.comment = comment
+        self.log_text = log_text
+        self.tag = tag
+        self.ban = ban
+        self.nuke = nuke
+        self.report_subreddit = report_subreddit
+        self.check_age = check_age
+
+
 class Filter(object):
     """Base filter class"""
     def __init__(self):
         self.regex = None
+        # fields of a post that self.regex is run against, see RegexIndex
+        self.regex_fields = ()
         self.comment_template = (
             "##This submission has been removed automatically.\nAccording to our [subreddit rules]("
             "/r/{sub}/wiki/rules/) {reason}.  If you feel this was in error, please [message the mo"
@@ -420,8 +1636,37 @@ class Filter(object):
         self.report_subreddit = None
         self.nuke = True
         self.reddit = None
-        self.database = Database(DATABASEFILE)
         self.check_age = True
+        # filterSubmission and filterComment only look at the post itself, so they can be run in
+        # another process (see FilterPool)
+        self.text_only = True
+
+    def verdict(self, **kwargs):
+        """Returns a Verdict with this filter's defaults, overridden by kwargs.  Filters never
+        change their own attributes once they're set up, so the same filter can look at any
+        number of posts at once."""
+        settings = {
+            'action': self.action, 'comment': self.comment, 'log_text': self.log_text,
+            'tag': self.tag, 'ban': self.ban, 'nuke': self.nuke,
+            'report_subreddit': self.report_subreddit, 'check_age': self.check_age}
+        settings.update(kwargs)
+        return Verdict(type(self).__name__, **settings)
+
+    def _may_match(self, post, field):
+        """False if the RegexIndex scan of post already proved self.regex can't match field."""
+        scan = post.get('_scan')
+        if scan is None or field not in self.regex_fields or field not in scan:
+            return True
+        return self in scan[field]
+
+    def _search(self, post, field):
+        if self._may_match(post, field):
+            return self.regex.search(post[field])
+
+    def _findall(self, post, field):
+        if self._may_match(post, field):
+            return self.regex.findall(post[field])
+        return []
 
     def filterComment(self, comment):
         raise NotImplementedError
@@ -429,24 +1674,59 @@ class Filter(object):
     def filterSubmission(self, submission):
         raise NotImplementedError
 
-    def runFilter(self, post):
+    def enrichSubmission(self, submission):
+        """Like filterSubmission, for checks that have to look things up on other sites.  These
+        run on the EnrichmentQueue after the cheap filters are done with the item."""
+        raise NotImplementedError
+
+    def enriches(self):
+        return type(self).enrichSubmission is not Filter.enrichSubmission
+
+    def checks(self, kind):
+        """Whether the filter has anything to say about a 'submission' or a 'comment'."""
+        if kind == 'submission':
+            return type(self).filterSubmission is not Filter.filterSubmission
+        return type(self).filterComment is not Filter.filterComment
+
+    def check(self, post):
+        """Returns a Verdict if the filter caught post, otherwise None."""
         if 'title' in post:
             try:
-                if self.filterSubmission(post):
-                    if self.log_text:
-                        logToDisk(self.log_text)
-                    return True
+                return self.filterSubmission(post)
             except NotImplementedError:
                 pass
         elif 'body' in post:
             try:
-                if self.filterComment(post):
-                    if self.log_text:
-                        logToDisk(self.log_text)
-                    return True
+                return self.filterComment(post)
             except NotImplementedError:
                 pass
 
+    def runFilter(self, post):
+        """Like check, and logs what was caught."""
+        name = type(self).__name__
+        with metrics.timer('moderator_filter_seconds', filter=name, stage='filter'):
+            verdict = self.check(post)
+        if verdict:
+            metrics.inc('moderator_filter_hits_total', filter=name, stage='filter')
+            if verdict.log_text:
+                logToDisk(verdict.log_text)
+            return verdict
+
+    def runEnrichment(self, post):
+        verdict = None
+        name = type(self).__name__
+        if 'title' in post:
+            try:
+                with metrics.timer('moderator_filter_seconds', filter=name, stage='enrichment'):
+                    verdict = self.enrichSubmission(post)
+            except NotImplementedError:
+                pass
+        if verdict:
+            metrics.inc('moderator_filter_hits_total', filter=name, stage='enrichment')
+            if verdict.log_text:
+                logToDisk(verdict.log_text)
+            return verdict
+
 
 class Suggestion(Filter):
     def __init__(self):
@@ -454,30 +1734,31 @@ class Suggestion(Filter):
         self.regex = re.compile(
             r'''((?:\[|<|\(|{|\*|\|)?sug*estion(?:\s|s?\]|s?>|s?\)|:|}|\*|\|'''
             r''')|(?:^|\[|<|\(|{|\*|\|)ideas?(?:\]|>|\)|:|}|\*|\|))''', re.I)
+        self.regex_fields = ('title',)
 
     def filterSubmission(self, submission):
-        if self.regex.search(submission['title']):
+        if self._search(submission, 'title'):
             link = 'http://reddit.com/r/{}/comments/{}/'.format(
                 submission['subreddit'], submission['id'])
 
             if submission['domain'] != 'self.{}'.format(submission['subreddit']):
                 reason = "suggestions must be self-post only"
-                self.log_text = "Found [Suggestion] submission that is not a self post"
-                self.comment = self.comment_template.format(
+                log_text = "Found [Suggestion] submission that is not a self post"
+                reply = self.comment_template.format(
                     sub=submission['subreddit'], reason=reason, link=link)
-                p(self.log_text + ":")
+                p(log_text + ":")
                 p(link, color_seed=submission['name'])
-                return True
+                return self.verdict(log_text=log_text, comment=reply)
             elif not submission['selftext']:
-                self.log_text = "Found [Suggestion] submission that has no self text"
+                log_text = "Found [Suggestion] submission that has no self text"
                 reason = (
                     "suggestion posts must have a description along with them, which is something y"
                     "ou cannot convey with only a title")
-                self.comment = self.comment_template.format(
+                reply = self.comment_template.format(
                     sub=submission['subreddit'], reason=reason, link=link)
-                p(self.log_text + ":")
+                p(log_text + ":")
                 p(link, color_seed=submission['name'])
-                return True
+                return self.verdict(log_text=log_text, comment=reply)
 
 
 class Fixed(Filter):
@@ -485,52 +1766,148 @@ class Fixed(Filter):
         Filter.__init__(self)
         self.regex = re.compile(
             r'''[\[|<\({\*]fixed[\]|>\):}\*]|i(?:'?ll)? see you'?re?,? .*? and raise you''', re.I)
+        self.regex_fields = ('title',)
         self.log_text = "Found [Fixed] submission"
 
     def filterSubmission(self, submission):
-        if self.regex.search(submission['title']):
+        if self._search(submission, 'title'):
             link = 'http://reddit.com/r/{}/comments/{}/'.format(
                 submission['subreddit'], submission['id'])
             reason = "[Fixed] submissions are not allowed"
-            self.comment = self.comment_template.format(
+            reply = self.comment_template.format(
                 sub=submission['subreddit'], reason=reason, link=link)
             p(self.log_text + ":")
             p(link, color_seed=submission['name'])
-            return True
+            return self.verdict(comment=reply)
+
+
+class DomainIndex(object):
+    """Finds any of a (big) list of strings in a text in one pass.
+
+    The strings are put in a trie, which is then written out as a regex of nested alternations,
+    so re walks the trie in C at each position of the text instead of us doing one substring
+    search per domain.  Since we only care whether something matches, a string that has a shorter
+    string as a prefix is dropped."""
+
+    def __init__(self, domains):
+        self.domains = frozenset(i.lower() for i in domains if i)
+        trie = {}
+        for domain in sorted(self.domains, key=len):
+            node = trie
+            for char in domain:
+                if '' in node:
+                    break
+                node = node.setdefault(char, {})
+            else:
+                node.clear()
+                node[''] = True
+        self.regex = re.compile(self._pattern(trie)) if self.domains else None
+
+    def _pattern(self, node):
+        if '' in node:
+            return ''
+        chars = []
+        alternatives = []
+        for char in sorted(node):
+            rest = self._pattern(node[char])
+            if rest:
+                alternatives.append(re.escape(char) + rest)
+            else:
+                chars.append(re.escape(char))
+        if len(chars) == 1:
+            alternatives.append(chars[0])
+        elif chars:
+            alternatives.append('[{}]'.format(''.join(chars)))
+        if len(alternatives) == 1:
+            return alternatives[0]
+        return '(?:{})'.format('|'.join(alternatives))
+
+    def search(self, text):
+        """True if any of the strings is in text, ignoring case."""
+        return self.regex is not None and self.regex.search(text.lower()) is not None
+
+
+class DomainBlacklist(object):
+    """The server domain blacklist from the SERVERDOMAINS wiki page.
+
+    A background thread keeps it fresh.  Downloads are conditional (ETag/Last-Modified), an
+    unchanged wiki revision is skipped, and the DomainIndex is only rebuilt when the content hash
+    changes.  Readers just use `self.index`, which is swapped out in one assignment and never
+    modified, so they don't need a lock or any staleness checks."""
+
+    def __init__(self, reddit, url, interval=1800):
+        self.reddit = reddit
+        self.url = url
+        self.interval = interval
+        self.index = DomainIndex([])
+        self.headers = {}
+        self.revision = None
+        self.digest = None
+        self.stopped = threading.Event()
+
+    def refresh(self):
+        response = self.reddit.fetch(self.url, self.headers)
+        if response is None or response.status == 304:
+            return
+        headers = {}
+        if response.headers.get('ETag'):
+            headers['If-None-Match'] = response.headers['ETag']
+        if response.headers.get('Last-Modified'):
+            headers['If-Modified-Since'] = response.headers['Last-Modified']
+        self.headers = headers
+        wiki = response.json()['data']
+        if self.revision and wiki.get('revision_id') == self.revision:
+            return
+        self.revision = wiki.get('revision_id')
+        blacklist = wiki['content_md'].strip()
+        digest = hashlib.sha1(blacklist.encode('utf-8')).hexdigest()
+        if digest == self.digest:
+            return
+        self.digest = digest
+        domain_list = [
+            i.strip() for i in blacklist.splitlines() if i.strip() and not i.startswith("//")]
+        index = DomainIndex(domain_list)
+        added = len(index.domains - self.index.domains)
+        removed = len(self.index.domains - index.domains)
+        if added:
+            p('Found {} new domains in online blacklist.'.format(added))
+        if removed:
+            p('Removed {} domains from the online blacklist'.format(removed))
+        self.index = index
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                # keep the list we have and try again next time
+                p('Could not update the domain blacklist: {}'.format(e))
+
+    def start(self):
+        """Loads the list, then keeps it up to date in the background."""
+        p('Updating domain blacklist...', end='')
+        self.refresh()
+        threading.Thread(target=self._run, name='blacklist', daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
 
 
 class ServerAd(Filter):
-    def __init__(self, reddit, imgur, youtube):
-        self.last_update = 0
-        self.domain_list = []
+    def __init__(self, reddit, imgur, youtube, blacklist):
         Filter.__init__(self)
         self.reddit = reddit
         self.imgur = imgur
         self.y = youtube
+        self.blacklist = blacklist
         self.tag = "[Server Spam]"
         self.regex = re.compile(
             r'''(?:^|\s|ip(?:=|:)|\*)(\d{1,3}(?:\.\d{1,3}){3})\.?(?:\s|$|:|\*|!|\.|,|;|\?)''', re.I)
 
-    def _update_list(self):
-        if (time.time() - self.last_update) >= 1800:
-            self.last_update = time.time()
-            p('Updating domain blacklist...', end='')
-            blacklist = self.reddit.get(SERVERDOMAINS)['data']['content_md'].strip()
-            domain_list = [i for i in re.split(r'''[\r\n]*''', blacklist) if not i.startswith("//")]
-            if len(self.domain_list) < len(domain_list):
-                p('Found {} new domains in online blacklist.'.format(
-                    len(domain_list) - len(self.domain_list)))
-            elif len(self.domain_list) > len(domain_list):
-                p('Removed {} domains from the online blacklist'.format(
-                    len(self.domain_list) - len(domain_list)))
-            self.domain_list = domain_list
-
     def _server_in(self, text):
-        self._update_list()
         if text:
-            for i in self.domain_list:
-                if i.lower() in text.lower():
-                    return True
+            if self.blacklist.index.search(text):
+                return True
             try:
                 ip = self.regex.findall(text)
                 if ip:
@@ -566,53 +1943,56 @@ class ServerAd(Filter):
         return False
 
     def filterSubmission(self, submission):
-        self.comment = ''
+        reply = ''
         if self._server_in(submission['title']) or\
             self._server_in(submission['selftext']) or\
                 self._server_in(submission['url'][7:]):
-            self.log_text = "Found server advertisement in submission"
+            log_text = "Found server advertisement in submission"
             link = 'http://reddit.com/r/{}/comments/{}/'.format(
                 submission['subreddit'], submission['id'])
             reason = "server advertisements are not allowed"
-            self.comment = self.comment_template.format(
+            reply = self.comment_template.format(
                 sub=submission['subreddit'], reason=reason, link=link)
-            p(self.log_text + ":")
+            p(log_text + ":")
             p(link, color_seed=submission['name'])
-            return True
-        elif submission['domain'] == 'imgur.com':
+            return self.verdict(comment=reply, log_text=log_text)
+
+    def enrichSubmission(self, submission):
+        reply = ''
+        if submission['domain'] == 'imgur.com':
             if self._imgur_check(submission['url']):
-                self.log_text = "Found server advertisement in submission"
+                log_text = "Found server advertisement in submission"
                 link = 'http://reddit.com/r/{}/comments/{}/'.format(
                     submission['subreddit'], submission['id'])
                 reason = "server advertisements are not allowed"
-                self.comment = self.comment_template.format(
+                reply = self.comment_template.format(
                     sub=submission['subreddit'], reason=reason, link=link)
-                p(self.log_text + ":")
+                p(log_text + ":")
                 p(link)
-                return True
-        elif submission['domain'] in ('m.youtube.com', 'youtube.com', 'youtu.be'):
+                return self.verdict(comment=reply, log_text=log_text)
+        elif submission['domain'] in YOUTUBE_DOMAINS:
             yt = self.y.get_info(submission['url'])
             if yt:
                 if self._server_in(yt['title']) or self._server_in(yt['description']):
-                    self.log_text = "Found server advertisement in submission"
+                    log_text = "Found server advertisement in submission"
                     link = 'http://reddit.com/r/{}/comments/{}/'.format(
                         submission['subreddit'], submission['id'])
                     reason = "server advertisements are not allowed"
-                    self.comment = self.comment_template.format(
+                    reply = self.comment_template.format(
                         sub=submission['subreddit'], reason=reason, link=link)
-                    p(self.log_text + ":")
+                    p(log_text + ":")
                     p(link, color_seed=submission['name'])
-                    return True
+                    return self.verdict(comment=reply, log_text=log_text)
 
     def filterComment(self, comment):
         if self._server_in(comment['body']):
-            self.comment = ''
-            self.log_text = "Found server advertisement in comment"
-            p(self.log_text + ":")
+            reply = ''
+            log_text = "Found server advertisement in comment"
+            p(log_text + ":")
             p('http://reddit.com/r/{}/comments/{}/a/{}'.format(
                 comment['subreddit'], comment['link_id'][3:], comment['id']),
                 color_seed=comment['link_id'])
-            return True
+            return self.verdict(comment=reply, log_text=log_text)
 
 
 class FreeMinecraft(Filter):
@@ -624,6 +2004,7 @@ class FreeMinecraft(Filter):
             r'''forever)?(?:\.blogspot)?|epicfreeprizes)[\[\(\{\.]*[\]\)\}]*?'''
             r'''(?:me|info|com|net|org|ru|co\.uk|us)''',
             re.I)
+        self.regex_fields = ('title', 'selftext', 'url', 'body')
         self.action = 'spammed'
         self.ban = True
 
@@ -643,32 +2024,32 @@ class FreeMinecraft(Filter):
 
     def filterSubmission(self, submission):
         for i in ('title', 'selftext', 'url'):
-            result = self.regex.findall(submission[i])
+            result = self._findall(submission, i)
             if result:
                 for i in result:
                     if not self.empty(result):
                         link = 'http://reddit.com/r/{}/comments/{}/'.format(
                             submission['subreddit'], submission['id'])
-                        self.log_text = "Found free Minecraft link in submission"
+                        log_text = "Found free Minecraft link in submission"
                         reason = "free minecraft links are not allowed"
-                        self.comment = self.comment_template.format(
+                        reply = self.comment_template.format(
                             sub=submission['subreddit'], reason=reason, link=link)
-                        p(self.log_text + ":")
+                        p(log_text + ":")
                         p(link, color_seed=submission['name'])
-                        return True
+                        return self.verdict(log_text=log_text, comment=reply)
 
     def filterComment(self, comment):
-        result = self.regex.findall(comment['body'])
+        result = self._findall(comment, 'body')
         if result:
             for i in result:
                 if not self.empty(result):
-                    self.comment = ''
-                    self.log_text = "Found free minecraft link in comment"
-                    p(self.log_text + ":")
+                    reply = ''
+                    log_text = "Found free minecraft link in comment"
+                    p(log_text + ":")
                     p('http://reddit.com/r/{}/comments/{}/a/{}'.format(
                         comment['subreddit'], comment['link_id'][3:], comment['id']),
                         color_seed=comment['link_id'])
-                    return True
+                    return self.verdict(comment=reply, log_text=log_text)
 
 
 class AmazonReferral(Filter):
@@ -676,29 +2057,30 @@ class AmazonReferral(Filter):
         Filter.__init__(self)
         self.regex = re.compile(
             r'''amazon\.(?:at|fr|com|ca|cn|de|es|it|co\.(?:jp|uk)).*?tag=.*?-20''', re.I)
+        self.regex_fields = ('title', 'selftext', 'url', 'body')
         self.tag = "[Amazon Referral Spam]"
         self.action = 'spammed'
         self.report_subreddit = 'reportthespammers'
 
     def filterSubmission(self, submission):
-        if self.regex.search(submission['title']) or\
-            self.regex.search(submission['selftext']) or\
-                self.regex.search(submission['url']):
-            self.log_text = "Found Amazon referral link in submission"
+        if self._search(submission, 'title') or\
+            self._search(submission, 'selftext') or\
+                self._search(submission, 'url'):
+            log_text = "Found Amazon referral link in submission"
             link = 'http://reddit.com/r/{}/comments/{}/'.format(
                 submission['subreddit'], submission['id'])
-            p(self.log_text + ":")
+            p(log_text + ":")
             p(link, color_seed=submission['name'])
-            return True
+            return self.verdict(log_text=log_text)
 
     def filterComment(self, comment):
-        if self.regex.search(comment['body']):
-            self.log_text = "Found Amazon referral link in comment"
-            p(self.log_text + ":")
+        if self._search(comment, 'body'):
+            log_text = "Found Amazon referral link in comment"
+            p(log_text + ":")
             p('http://reddit.com/r/{}/comments/{}/a/{}'.format(
                 comment['subreddit'], comment['link_id'][3:], comment['id']),
                 color_seed=comment['link_id'])
-            return True
+            return self.verdict(log_text=log_text)
 
 
 class ShortUrl(Filter):
@@ -708,30 +2090,31 @@ class ShortUrl(Filter):
             r'''(?:bit\.ly|goo\.gl|adf\.ly|is\.gd|t\.co|tinyurl\.com|j\.mp|'''
             r'''tiny\.cc|soc\.li|ultrafiles\.net|linkbucks\.com|lnk\.co|qvvo\.com|ht\.ly|'''
             r'''pulse\.me|lmgtfy\.com|\.tk)/''', re.I)
+        self.regex_fields = ('title', 'selftext', 'url', 'body')
 
     def filterSubmission(self, submission):
-        if self.regex.search(submission['title']) or\
-            self.regex.search(submission['selftext']) or\
-                self.regex.search(submission['url']):
+        if self._search(submission, 'title') or\
+            self._search(submission, 'selftext') or\
+                self._search(submission, 'url'):
             link = 'http://reddit.com/r/{}/comments/{}/'.format(
                 submission['subreddit'], submission['id'])
-            self.log_text = "Found short url in submission"
+            log_text = "Found short url in submission"
             reason = "short urls are not allowed"
-            self.comment = self.comment_template.format(
+            reply = self.comment_template.format(
                 sub=submission['subreddit'], reason=reason, link=link)
-            p(self.log_text + ":")
+            p(log_text + ":")
             p(link, color_seed=submission['name'])
-            return True
+            return self.verdict(log_text=log_text, comment=reply)
 
     def filterComment(self, comment):
-        if self.regex.search(comment['body']):
-            self.comment = ''
-            self.log_text = "Found short url in comment"
-            p(self.log_text + ":")
+        if self._search(comment, 'body'):
+            reply = ''
+            log_text = "Found short url in comment"
+            p(log_text + ":")
             p('http://reddit.com/r/{}/comments/{}/a/{}'.format(
                 comment['subreddit'], comment['link_id'][3:], comment['id']),
                 color_seed=comment['link_id'])
-            return True
+            return self.verdict(comment=reply, log_text=log_text)
 
 
 class Failed(Filter):
@@ -742,50 +2125,52 @@ class Failed(Filter):
         link = 'http://reddit.com/r/{}/comments/{}/'.format(
             submission['subreddit'], submission['id'])
         if submission['domain'].startswith('['):
-            self.log_text = "Found submission with formatting in the url"
-            self.comment = (
+            log_text = "Found submission with formatting in the url"
+            reply = (
                 "You've seemed to try to use markdown or other markup in the url field"
                 " when you made this submission. Markdown formatting is only for self text and comm"
                 "enting; other formatting code is invalid on reddit. When you make a link submissio"
                 "n, please only enter the bare link in the url field.\n\nFeel free to try submitti"
                 "ng again.")
-            p(self.log_text + ":")
+            p(log_text + ":")
             p(link, color_seed=submission['name'])
-            return True
+            return self.verdict(log_text=log_text, comment=reply)
         elif '.' not in submission['domain']:
-            self.log_text = "Found submission with invalid url"
-            self.comment = (
+            log_text = "Found submission with invalid url"
+            reply = (
                 "The submission you've made does not have a valid url in it.  Please t"
                 "ry resubmitting and pay special attention to what you're typing/pasting in the ur"
                 "l field.")
-            p(self.log_text + ":")
+            p(log_text + ":")
             p(link, color_seed=submission['name'])
-            return True
+            return self.verdict(log_text=log_text, comment=reply)
 
 
 class Minebook(Filter):
     def __init__(self):
         Filter.__init__(self)
         self.regex = re.compile(r'''minebook\.me''', re.I)
+        self.regex_fields = ('title', 'selftext', 'body')
         self.action = 'spammed'
 
     def filterSubmission(self, submission):
-        if self.regex.search(submission['title']) or\
-            self.regex.search(submission['selftext']) or\
+        if self._search(submission, 'title') or\
+            self._search(submission, 'selftext') or\
                 submission['domain'] == 'minebook.me':
-            self.log_text = "Found minebook in submission"
-            p(self.log_text + ":")
+            log_text = "Found minebook in submission"
+            p(log_text + ":")
             p('http://reddit.com/r/{}/comments/{}/'.format(
                 submission['subreddit'], submission['id']), color_seed=submission['name'])
-            return True
+            return self.verdict(log_text=log_text)
 
     def filterComment(self, comment):
-        if self.regex.search(comment['body']):
-            self.log_text = "Found minebook in comment"
-            p(self.log_text + ":")
+        if self._search(comment, 'body'):
+            log_text = "Found minebook in comment"
+            p(log_text + ":")
             p('http://reddit.com/r/{}/comments/{}/a/{}'.format(
                 comment['subreddit'], comment['link_id'][3:], comment['id']),
-                color_seed=submission['name'])
+                color_seed=comment['link_id'])
+            return self.verdict(log_text=log_text)
 
 
 class SelfLinks(Filter):
@@ -799,46 +2184,51 @@ class SelfLinks(Filter):
                 if not self.regex.match(i):
                     break
             else:
-                self.comment = (
+                reply = (
                     "This submission has been removed automatically.  You appear to ha"
                     "ve only included links in your self-post with no explanatory text.  Please res"
                     "ubmit or edit your post accordingly.")
-                self.log_text = "Found self-post that only contained links"
-                p(self.log_text + ":")
+                log_text = "Found self-post that only contained links"
+                p(log_text + ":")
                 p('http://reddit.com/r/{}/comments/{}/'.format(
                     submission['subreddit'], submission['id']), color_seed=submission['name'])
-                return True
+                return self.verdict(comment=reply, log_text=log_text)
 
 
 class BadWords(Filter):
     def __init__(self):
         Filter.__init__(self)
         self.action = 'report'
+        self.badwords = ['gay', 'fag', 'fgt', 'cunt', 'nigger', 'nigga', 'retard', 'autis']
+        self.regex = re.compile('|'.join(re.escape(i) for i in self.badwords), re.I)
+        self.regex_fields = ('body',)
 
     def filterComment(self, comment):
-        badwords = ['gay', 'fag', 'fgt', 'cunt', 'nigger', 'nigga', 'retard', 'autis']
-        if not comment['num_reports']:
-            for word in badwords:
+        if not comment['num_reports'] and self._may_match(comment, 'body'):
+            for word in self.badwords:
                 if word in comment['body'].lower():
-                    self.log_text = "Found comment for mod review"
-                    p(self.log_text + ":", end="")
+                    log_text = "Found comment for mod review"
+                    p(log_text + ":", end="")
                     p('http://reddit.com/r/{}/comments/{}/a/{}'.format(
                         comment['subreddit'], comment['link_id'][3:], comment['id']),
                         color_seed=comment['link_id'], end="")
-                    return True
+                    return self.verdict(log_text=log_text)
 
 
 class YoutubeSpam(Filter):
-    def __init__(self, reddit, youtube):
+    def __init__(self, reddit, youtube, store):
         Filter.__init__(self)
         self.tag = "[Youtube Spam]"
         self.check_age = False
         self.reddit = reddit
         self.y = youtube
+        self.store = store
+        self.executor = ThreadPoolExecutor(max_workers=4)
+        self.text_only = False
 
     def _isVideo(self, submission):
         '''Returns video author name if this is a video'''
-        if submission['domain'] in ('m.youtube.com', 'youtube.com', 'youtu.be'):
+        if submission['domain'] in YOUTUBE_DOMAINS:
             return self.y.get_author(submission['url'])
 
     def _checkProfile(self, user):
@@ -847,72 +2237,108 @@ class YoutubeSpam(Filter):
             * linking to videos of the same author (which implies it is their account)
             * commenting on your own submissions (not just videos)
         these all will count against the user and an overall score will be returned.  Also, we only
-        check against the last 100 items on the user's profile.'''
+        check against the last 100 items on the user's profile.
+
+        Video authors are looked up at the same time, once per distinct video, and remembered per
+        user, so a repeat check only looks up what was posted since the last one.  We give up as
+        soon as the user can't reach the thresholds any more, even if every video left turned out
+        to be theirs.'''
 
         try:
+            # network errors are let through, so the enrichment queue tries again later
             comments = self.reddit.get(
-                'http://www.reddit.com/user/{}/comments/.json?limit=100&sort=new'.format(user))
-            comments = comments['data']['children']
+                'http://www.reddit.com/user/{}/comments/.json?limit=100&sort=new'.format(user),
+                raise_errors=True)
+            comments = [i['data'] for i in comments['data']['children']]
             submitted = self.reddit.get(
-                'http://www.reddit.com/user/{}/submitted/.json?limit=100&sort=new'.format(user))
-            submitted = submitted['data']['children']
-        except urllib.error.HTTPError:
+                'http://www.reddit.com/user/{}/submitted/.json?limit=100&sort=new'.format(user),
+                raise_errors=True)
+            submitted = [i['data'] for i in submitted['data']['children']]
+        except (urllib.error.HTTPError, KeyError):
             # This is a hack to get around shadowbanned or deleted users
             p("Could not parse /u/{}, probably shadowbanned or deleted".format(user))
             return False
-        video_count = defaultdict(lambda: 0)
-        video_submissions = set()
-        comments_on_self = 0
-        for item in submitted:
-            item = item['data']
-            video_author = self._isVideo(item)
-            if video_author:
-                video_count[video_author] += 1
-                video_submissions.add(item['name'])
+        total = len(comments) + len(submitted)
+        comment_count = defaultdict(lambda: 0)
         for item in comments:
-            item = item['data']
-            if item['link_id'] in video_submissions:
-                comments_on_self += 1
+            comment_count[item['link_id']] += 1
+
+        def reachable(videos, unresolved):
+            """Could the user still be a spammer if every unresolved video is theirs?"""
+            names = videos | unresolved
+            best = len(names) + sum(comment_count[i] for i in names)
+            return len(names) >= 3 and best / total > .85
+
+        # only youtube links can be videos, so that's all we have to look up
+        candidates = [i for i in submitted if i['domain'] in YOUTUBE_DOMAINS]
+        if not candidates or not reachable(set(), {i['name'] for i in candidates}):
+            return False
+
+        known = self.store.get_profile(user)
+        authors = {i['name']: known[i['name']] for i in candidates if i['name'] in known}
+        by_video = defaultdict(list)
+        for item in candidates:
+            if item['name'] not in authors:
+                by_video[self.y._get_id(item['url']) or item['url']].append(item)
+        videos = {name for name, author in authors.items() if author}
+        unresolved = {i['name'] for i in candidates if i['name'] not in authors}
+
+        lookups = {
+            self.executor.submit(self._isVideo, items[0]): items for items in by_video.values()}
+        for lookup in as_completed(lookups):
+            author = lookup.result()
+            for item in lookups[lookup]:
+                authors[item['name']] = author or ''
+                unresolved.discard(item['name'])
+                if author:
+                    videos.add(item['name'])
+            if not reachable(videos, unresolved):
+                for i in lookups:
+                    i.cancel()
+                break
+        self.store.save_profile(user, authors)
+        if unresolved:
+            return False
+
+        video_count = defaultdict(lambda: 0)
+        for name in videos:
+            video_count[authors[name]] += 1
+        comments_on_self = sum(comment_count[i] for i in videos)
         try:
             video_percent = max(
                 [video_count[i] / sum(video_count.values()) for i in video_count])
         except ValueError:
             video_percent = 0
         if video_percent > .85 and sum(video_count.values()) >= 3:
-            spammer_value = (sum(video_count.values()) + comments_on_self) / (len(
-                comments) + len(submitted))
+            spammer_value = (sum(video_count.values()) + comments_on_self) / total
             if spammer_value > .85:
                 return True
 
-    def filterSubmission(self, submission):
-        self.report_subreddit = None
+    def enrichSubmission(self, submission):
+        report_subreddit = None
         DAY = 24 * 60 * 60
-        if submission['domain'] in ('m.youtube.com', 'youtube.com', 'youtu.be'):
+        if submission['domain'] in YOUTUBE_DOMAINS:
             link = 'http://reddit.com/r/{}/comments/{}/'.format(
                 submission['subreddit'], submission['id'])
             # check if we've already parsed this submission
-            with self.database.open() as db:
-                if submission['id'] in db['submissions']:
-                    return False
-                if submission['author'] in db['users']:
-                    user = db['users'][submission['author']]
-                else:
-                    user = {'checked_last': 0, 'warned': False, 'banned': False}
+            if self.store.has_submission(submission['id']):
+                return None
+            user = self.store.get_user(submission['author'])
 
             if time.time() - user['checked_last'] > DAY:
                 p("Checking profile of /u/{}".format(submission['author']), end='')
                 user['checked_last'] = time.time()
                 if self._checkProfile(submission['author']):
                     if user['warned']:
-                        self.log_text = "Confirmed video spammer"
-                        p(self.log_text + ":")
-                        self.comment = ''
-                        self.report_subreddit = 'reportthespammers'
-                        self.ban = True
-                        self.nuke = True
+                        log_text = "Confirmed video spammer"
+                        p(log_text + ":")
+                        reply = ''
+                        report_subreddit = 'reportthespammers'
+                        ban = True
+                        nuke = True
                         user['banned'] = True
                     else:
-                        self.comment = (
+                        reply = (
                             """It looks like you might be skirting on the line with  """
                             """submitting your videos, so consider this a friendly warning/guidel"""
                             """ine:\n\nReddit has [guidelines as to what constitutes spam](/help/"""
@@ -940,22 +2366,20 @@ class YoutubeSpam(Filter):
                             """bove definition.\n\nIf you feel this was in error, feel free to [m"""
                             """essage the moderators](/message/compose/?to=/r/{0}&subject=Video%"""
                             """20Spam&message={1}).""".format(SUBREDDIT, link))
-                        self.ban = False
-                        self.nuke = False
-                        self.log_text = "Found potential video spammer"
-                        p(self.log_text + ":")
+                        ban = False
+                        nuke = False
+                        log_text = "Found potential video spammer"
+                        p(log_text + ":")
                         p("http://reddit.com/u/{}".format(submission['author']),
                             color_seed=submission['author'])
                         user['warned'] = True
-                    with self.database.open() as db:
-                        db['users'][submission['author']] = user
-                        db['submissions'].append(submission['id'])
-                    output = True
+                    output = self.verdict(
+                        log_text=log_text, comment=reply, report_subreddit=report_subreddit,
+                        ban=ban, nuke=nuke)
                 else:
-                    output = False
-                with self.database.open() as db:
-                    db['users'][submission['author']] = user
-                    db['submissions'].append(submission['id'])
+                    output = None
+                self.store.save_user(submission['author'], user)
+                self.store.add_submission(submission['id'])
                 return output
 
 
@@ -973,8 +2397,8 @@ class AllCaps(Filter):
         title_caps = re.findall(r'''[A-Z]''', submission['title'])
         if len(title) > 10:
             if len(title_caps) / len(title) > .7:
-                self.log_text = "Found submission with all-caps title"
-                p(self.log_text + ":")
+                log_text = "Found submission with all-caps title"
+                p(log_text + ":")
                 p('http://reddit.com/r/{}/comments/{}/'.format(
                     submission['subreddit'], submission['id']), color_seed=submission['name'])
                 params = {'title': submission['title'].title(), 'resubmit': True}
@@ -982,21 +2406,26 @@ class AllCaps(Filter):
                     params['text'] = submission['selftext']
                 else:
                     params['url'] = submission['url']
-                self.comment = self.comment_template.format(
+                reply = self.comment_template.format(
                     link='/r/{}/submit?{}'.format(submission['subreddit'], urlencode(params)))
-                return True
+                return self.verdict(log_text=log_text, comment=reply)
 
 
 class BannedSubs(Filter):
     def __init__(self):
         Filter.__init__(self)
         self.action = 'spammed'
+        # the bodies are compared lowercased, so the list from credentials.py has to be too
+        self.words = [i.lower() for i in BANNEDSUBS]
+        if self.words:
+            self.regex = re.compile('|'.join(re.escape(i) for i in self.words), re.I)
+            self.regex_fields = ('body',)
 
     def filterComment(self, comment):
-        if not comment['num_reports']:
-            for word in BANNEDSUBS:
+        if not comment['num_reports'] and self._may_match(comment, 'body'):
+            for word in self.words:
                 if word in comment['body'].lower():
-                    return True
+                    return self.verdict()
 
 
 class Meme(Filter):
@@ -1020,21 +2449,21 @@ class Meme(Filter):
                     'url': submission['url']}
                 resubmit = '/r/{}/submit?{}'.format('memecraft', urlencode(params))
                 reason = "meme submissions are not allowed"
-                self.comment = self.comment_template.format(
+                reply = self.comment_template.format(
                     sub=submission['subreddit'], reason=reason, link=link, resubmit=resubmit)
-                self.action = 'spammed'
-                self.log_text = "Found meme submission"
-                p(self.log_text + ":")
+                action = 'spammed'
+                log_text = "Found meme submission"
+                p(log_text + ":")
                 p(link, color_seed=submission['name'])
-                return True
+                return self.verdict(comment=reply, action=action, log_text=log_text)
         else:
             if 'meme' in submission['url']:
-                self.comment = ""
-                self.action = 'report'
-                self.log_text = "Found suspected meme submission"
-                p(self.log_text + ":")
+                reply = ""
+                action = 'report'
+                log_text = "Found suspected meme submission"
+                p(log_text + ":")
                 p(link)
-                return True
+                return self.verdict(comment=reply, action=action, log_text=log_text)
 
 
 class InaneTitle(Filter):
@@ -1056,8 +2485,8 @@ class InaneTitle(Filter):
         matches = self.regex.findall(submission['title'].strip())
         if matches:
             matches = "\n\n* ".join(matches)
-            self.log_text = "Found submission with inane title"
-            p(self.log_text + ":")
+            log_text = "Found submission with inane title"
+            p(log_text + ":")
             p('http://reddit.com/r/{}/comments/{}/'.format(
                 submission['subreddit'], submission['id']), color_seed=submission['name'])
             params = {'resubmit': True}
@@ -1065,36 +2494,37 @@ class InaneTitle(Filter):
                 params['text'] = submission['selftext']
             else:
                 params['url'] = submission['url']
-            self.comment = self.comment_template.format(
+            reply = self.comment_template.format(
                 sub=submission['subreddit'], params=urlencode(params), matches=matches)
-            return True
+            return self.verdict(log_text=log_text, comment=reply)
 
 
 class SpamNBan(Filter):
     def __init__(self):
         Filter.__init__(self)
         self.regex = re.compile(r'''teslabots\.jimbo\.com|topminecraftworldseeds\.com''')
+        self.regex_fields = ('title', 'selftext', 'url', 'body')
         self.ban = True
         self.action = 'spammed'
 
     def filterSubmission(self, submission):
-        if self.regex.search(submission['title']) or\
-            self.regex.search(submission['selftext']) or\
-                self.regex.search(submission['url']):
-            self.log_text = "Found spam domain in submission"
-            p(self.log_text + ":")
+        if self._search(submission, 'title') or\
+            self._search(submission, 'selftext') or\
+                self._search(submission, 'url'):
+            log_text = "Found spam domain in submission"
+            p(log_text + ":")
             p('http://reddit.com/r/{}/comments/{}/'.format(
                 submission['subreddit'], submission['id']), color_seed=submission['name'])
-            return True
+            return self.verdict(log_text=log_text)
 
     def filterComment(self, comment):
-        if self.regex.search(comment['body']):
-            self.log_text = "Found spam domain in comment"
-            p(self.log_text + ":")
+        if self._search(comment, 'body'):
+            log_text = "Found spam domain in comment"
+            p(log_text + ":")
             p('http://reddit.com/r/{}/comments/{}/a/{}'.format(
                 comment['subreddit'], comment['link_id'][3:], comment['id']),
                 color_seed=comment['link_id'])
-            return True
+            return self.verdict(log_text=log_text)
 
 
 class FileDownload(Filter):
@@ -1110,28 +2540,30 @@ class FileDownload(Filter):
             r'''depositfiles|fileserve|zippyshare|esnips|filefactory|uploaded\.to|2shared|'''
             r'''fileswap|filehosting|assets\.minecraft\.net|\.jar$|\.exe$|\.zip$|\.tar\.gz$|'''
             r'''\.tar\bz2$|dl\.dropbox\.com''', re.I)
+        self.regex_fields = ('url',)
 
     def filterSubmission(self, submission):
-        if self.regex.search(submission['url']):
-            return True
+        if self._search(submission, 'url'):
+            return self.verdict()
 
 
 class ChunkError(Filter):
     def __init__(self):
         Filter.__init__(self)
         self.regex = re.compile(r'''terrain(?: generation)? (?:error|glitch)''')
+        self.regex_fields = ('title',)
         self.log_text = "Found chunk error/glitch submission"
 
     def filterSubmission(self, submission):
-        if self.regex.search(submission['title']):
+        if self._search(submission, 'title'):
             link = 'http://reddit.com/r/{}/comments/{}/'.format(
                 submission['subreddit'], submission['id'])
             reason = "terrain generation glitches/errors submissions are not allowed"
-            self.comment = self.comment_template.format(
+            reply = self.comment_template.format(
                 sub=submission['subreddit'], reason=reason, link=link)
             p(self.log_text + ":")
             p(link, color_seed=submission['name'])
-            return True
+            return self.verdict(comment=reply)
 
 
 class Facebook(Filter):
@@ -1142,14 +2574,14 @@ class Facebook(Filter):
 
     def filterSubmission(self, submission):
         if self.regex.search(submission['domain']):
-            self.comment = (
+            reply = (
                 """Hey there! I removed your post since it linked to a facebook page, which can """
                 """be traced back to a user profile. You should re-upload the picture somewhere e"""
                 """lse like [imgur](http://imgur.com) or [minus](http://minus.com) and resubmit.""")
             p(self.log_text + ":")
             p('http://reddit.com/r/{}/comments/{}/'.format(
                 submission['subreddit'], submission['id']), color_seed=submission['name'])
-            return True
+            return self.verdict(comment=reply)
 
 
 class Reditr(Filter):
@@ -1164,7 +2596,7 @@ class Reditr(Filter):
             p('http://reddit.com/r/{}/comments/{}/a/{}'.format(
                 comment['subreddit'], comment['link_id'][3:], comment['id']),
                 color_seed=comment['link_id'])
-            return True
+            return self.verdict()
 
 
 class Flair(Filter):
@@ -1172,6 +2604,8 @@ class Flair(Filter):
         Filter.__init__(self)
         self.reddit = reddit
         self.nuke = False
+        # sets flair on reddit, so it has to run in the main process
+        self.text_only = False
 
     def filterSubmission(self, submission):
         if not submission['link_flair_css_class']:
@@ -1194,83 +2628,870 @@ class Flair(Filter):
             self.reddit.post('http://www.reddit.com/api/selectflair', body)
 
 
-def main():
-    sleep_time = 60 * 3
-    r = Reddit(USERNAME, PASSWORD)
-    imgur = Imgur(IMGUR_CLIENT_ID)
-    y = Youtube()
-    last_status = None
-    processed = {'ids': [], 'authors': []}
-    p('Started monitoring submissions on /r/{}.'.format(SUBREDDIT))
+def kind(post):
+    return 'submission' if 'title' in post else 'comment'
+
+
+def route_filters(filters):
+    """{'submission': [...], 'comment': [...]}, the filters that check each kind of post, in
+    order."""
+    return {i: [f for f in filters if f.checks(i)] for i in ('submission', 'comment')}
+
+
+def build_filters(reddit, imgur, youtube, store, blacklist):
+    """Every filter, in the order they get to look at a post."""
+    return [
+        Flair(reddit), Suggestion(), Fixed(), ServerAd(reddit, imgur, youtube, blacklist),
+        FreeMinecraft(), AmazonReferral(), ShortUrl(), Failed(), Minebook(), SelfLinks(),
+        BadWords(), YoutubeSpam(reddit, youtube, store), BannedSubs(), Meme(), InaneTitle(),
+        SpamNBan(), AllCaps(), FileDownload(), ChunkError(), Facebook(), Reditr()]
+
+
+class EnrichmentQueue(object):
+    """Runs the filters that have to look things up on other sites (see
+    Filter.enrichSubmission) on their own thread pool, so one slow item doesn't hold up the
+    cheap filters for everything behind it.
+
+    Each item gets `deadline` seconds; filters that haven't started by then are skipped.  A
+    filter that fails with a network error is retried `retries` times, waiting `backoff`, then
+    twice that, and so on.  Only one item per author is looked at at a time, the rest wait their
+    turn, so a second submission sees what the first one found out about the user (and they
+    don't get warned twice).  Whatever the filters catch is picked up with results()."""
+
+    def __init__(self, workers=4, deadline=120, retries=2, backoff=2):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.deadline = deadline
+        self.retries = retries
+        self.backoff = backoff
+        self.pending = set()
+        # author: items of theirs waiting for the one that's running
+        self.waiting = {}
+        self.lock = threading.Lock()
+        self.finished = queue.Queue()
+        self.closing = threading.Event()
+
+    def submit(self, item, filters):
+        deadline = time.monotonic() + self.deadline
+        with self.lock:
+            if item['author'] in self.waiting:
+                self.waiting[item['author']].append((item, filters, deadline))
+                return
+            self.waiting[item['author']] = deque()
+        self._start(item, filters, deadline)
+
+    def _start(self, item, filters, deadline):
+        try:
+            future = self.executor.submit(self._run, item, filters, deadline)
+        except RuntimeError:
+            # shut down by close()
+            return
+        with self.lock:
+            self.pending.add(future)
+        future.add_done_callback(lambda future: self._done(future, item['author']))
+
+    def _run(self, item, filters, deadline):
+        for f in filters:
+            for attempt in range(self.retries + 1):
+                if time.monotonic() > deadline:
+                    p('Gave up on enrichment of {}, took too long'.format(item['name']))
+                    return None
+                try:
+                    verdict = f.runEnrichment(item)
+                    if verdict:
+                        return item, verdict
+                    break
+                except (urllib.error.URLError, http.client.HTTPException, OSError) as e:
+                    if attempt == self.retries:
+                        p('{} failed on {}: {}'.format(type(f).__name__, item['name'], e))
+                    elif self.closing.wait(self.backoff * 2 ** attempt):
+                        return None
+        return None
 
-    filters = [
-        Flair(r), Suggestion(), Fixed(), ServerAd(r, imgur, y), FreeMinecraft(), AmazonReferral(),
-        ShortUrl(), Failed(), Minebook(), SelfLinks(), BadWords(), YoutubeSpam(r, y), BannedSubs(),
-        Meme(), InaneTitle(), SpamNBan(), AllCaps(), FileDownload(), ChunkError(), Facebook(),
-        Reditr()]
+    def _done(self, future, author):
+        with self.lock:
+            waiting = self.waiting[author]
+            if waiting:
+                following = waiting.popleft()
+            else:
+                following = None
+                del self.waiting[author]
+        # the next one is pending before this one stops being, so results() doesn't stop waiting
+        # in between
+        if following:
+            self._start(*following)
+        with self.lock:
+            self.pending.discard(future)
+        if not future.cancelled() and future.exception() is None and future.result():
+            self.finished.put(future.result())
+        elif not future.cancelled() and future.exception() is not None:
+            p('Enrichment failed: {}'.format(future.exception()))
+
+    def close(self):
+        """Drops everything that hasn't started yet, so exiting doesn't wait for it."""
+        self.closing.set()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def results(self, timeout=0):
+        """Returns (item, verdict) for every item caught since the last call, waiting up to
+        `timeout` seconds for the ones still running."""
+        end = time.monotonic() + timeout
+        while timeout:
+            # items waiting on another by the same author only start once it's done
+            with self.lock:
+                pending = list(self.pending)
+            if not pending or time.monotonic() >= end:
+                break
+            wait(pending, end - time.monotonic(), FIRST_COMPLETED)
+        output = []
+        while True:
+            try:
+                output.append(self.finished.get_nowait())
+            except queue.Empty:
+                return output
 
-    # main loop
-    while True:
-        p('Getting feed...', end='')
-        new_listing = r.get('http://reddit.com/r/{}/new/.json?sort=new'.format(SUBREDDIT))
-        modqueue_listing = r.get('http://reddit.com/r/{}/about/modqueue.json'.format(SUBREDDIT))
-        comments_listing = r.get('http://reddit.com/r/{}/comments/.json'.format(SUBREDDIT))
-        feed = []
-        status = mojangStatus()
+
+# the only parts of a post the text-only filters look at
+POOL_FIELDS = (
+    'title', 'selftext', 'url', 'domain', 'body', 'subreddit', 'id', 'name', 'link_id',
+    'num_reports', 'link_flair_css_class')
+
+# set up once in each FilterPool worker by _init_pool_worker
+_pool_filters = {}
+_pool_index = None
+
+
+def _init_pool_worker(domains):
+    global _pool_filters, _pool_index
+    # ^c is the main process' business, it takes the pool down with it
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    blacklist = DomainBlacklist(None, None)
+    blacklist.index = DomainIndex(domains)
+    filters = [f for f in build_filters(None, None, None, None, blacklist) if f.text_only]
+    _pool_filters = route_filters(filters)
+    _pool_index = RegexIndex(filters)
+
+
+def _pool_check(post):
+    post['_scan'] = _pool_index.scan(post)
+    for f in _pool_filters[kind(post)]:
+        verdict = f.check(post)
+        if verdict:
+            return verdict
+
+
+class FilterPool(object):
+    """Runs the text-only filters over a batch of posts on a multiprocessing pool, so catching up
+    on a few pages of long comments isn't stuck on one core.
+
+    Every worker builds its own filters and RegexIndex once, when it starts.  Only the
+    POOL_FIELDS of each post are sent over, and Verdicts come back in the order the posts went
+    in.  The pool is started again whenever the domain blacklist changes."""
+
+    def __init__(self, blacklist, processes=None):
+        self.blacklist = blacklist
+        self.processes = processes or os.cpu_count() or 1
+        self.pool = None
+        self.index = None
+
+    def _get_pool(self):
+        index = self.blacklist.index
+        if self.pool is None or index is not self.index:
+            self.close()
+            self.index = index
+            self.pool = multiprocessing.Pool(
+                self.processes, _init_pool_worker, (sorted(index.domains),))
+        return self.pool
+
+    def check(self, posts):
+        """Returns a Verdict or None for each post."""
+        if not posts:
+            return []
+        slim = [{k: post[k] for k in POOL_FIELDS if k in post} for post in posts]
+        chunksize = max(1, len(slim) // (self.processes * 4))
+        return self._get_pool().map(_pool_check, slim, chunksize)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
+# lower goes first: get spam out of sight before anything else
+ACTION_PRIORITY = {
+    'remove': 0, 'report': 0, 'ban': 1, 'hide': 2, 'comment': 3, 'distinguish': 3, 'rts': 4}
+
+# actions that come out the same if reddit gets them twice.  A comment or an rts post that failed
+# after it was sent may still have gone through, so those are never retried.
+IDEMPOTENT_ACTIONS = frozenset(('remove', 'report', 'ban', 'hide', 'distinguish'))
+
+
+class Action(object):
+    """One call to make on reddit.  `function` may return more Actions to run after it, like a
+    comment's distinguish."""
+
+    def __init__(self, kind, target, function, *args):
+        self.kind = kind
+        self.target = target
+        self.function = function
+        self.args = args
+        self.priority = ACTION_PRIORITY[kind]
+
+    def __repr__(self):
+        return '{} {}'.format(self.kind, self.target)
+
+
+class ActionDispatcher(object):
+    """Queues up moderation actions and carries them out in bulk.
+
+    An action that is already queued (the same kind on the same target) is dropped.  run() starts
+    them in priority order on a few threads, so removals go out first and the rest follow without
+    waiting on each other; the reddit RateLimiter keeps them within budget.  Network errors and
+    5xx responses are retried `retries` times, waiting `backoff`, then twice that, and so on, for
+    the IDEMPOTENT_ACTIONS.
+    What happened to each action is kept in self.results."""
+
+    def __init__(self, workers=4, retries=2, backoff=2):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.retries = retries
+        self.backoff = backoff
+        self.queued = OrderedDict()
+        self.lock = threading.Lock()
+        self.results = deque(maxlen=1000)
+
+    def add(self, action):
+        key = (action.kind, action.target)
+        with self.lock:
+            if key not in self.queued:
+                self.queued[key] = action
+
+    def _attempt(self, action):
+        """Returns whether action went through, and the actions that follow it."""
+        for attempt in range(1, self.retries + 2):
+            try:
+                followups = action.function(*action.args)
+                metrics.inc('moderator_actions_total', kind=action.kind, result='ok')
+                self.results.append((time.time(), repr(action), True, attempt, None))
+                return True, followups if isinstance(followups, list) else []
+            except (urllib.error.URLError, http.client.HTTPException, OSError) as e:
+                error = e
+                if isinstance(e, urllib.error.HTTPError) and e.code < 500:
+                    break
+                if action.kind not in IDEMPOTENT_ACTIONS:
+                    break
+                if attempt <= self.retries:
+                    time.sleep(self.backoff * 2 ** (attempt - 1))
+            except (ValueError, LookupError, TypeError) as e:
+                # reddit answered, but not with what we wanted; asking again won't help
+                error = e
+                break
+        p('Could not {}: {}'.format(action, error))
+        metrics.inc('moderator_actions_total', kind=action.kind, result='failed')
+        self.results.append((time.time(), repr(action), False, attempt, str(error)))
+        return False, []
+
+    def run(self):
+        """Carries out everything queued so far and waits for it to finish.  Returns how many
+        actions went through and how many failed."""
+        with self.lock:
+            actions = sorted(self.queued.values(), key=lambda i: i.priority)
+            self.queued = OrderedDict()
+        succeeded = failed = 0
+        running = {self.executor.submit(self._attempt, i) for i in actions}
+        while running:
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                ok, followups = future.result()
+                if ok:
+                    succeeded += 1
+                else:
+                    failed += 1
+                for action in followups:
+                    running.add(self.executor.submit(self._attempt, action))
+        return succeeded, failed
+
+
+class ModeratorBot(object):
+    """Holds everything the main loop needs between cycles."""
+
+    def __init__(self, processes=0):
+        self.r = Reddit(USERNAME, PASSWORD)
+        self.imgur = Imgur(IMGUR_CLIENT_ID)
+        self.y = Youtube()
+        self.last_status = None
+        self.seen = SeenItems(DATABASEFILE + '.seen')
+        # comments come in fastest, and the modqueue mostly fills up from the other two
+        self.listings = [
+            ListingCursor(
+                self.r, 'http://reddit.com/r/{}/new/.json?sort=new'.format(SUBREDDIT),
+                schedule=PollSchedule(max_interval=600)),
+            ListingCursor(
+                self.r, 'http://reddit.com/r/{}/about/modqueue.json'.format(SUBREDDIT),
+                use_before=False, schedule=PollSchedule(min_interval=15, max_interval=900)),
+            ListingCursor(
+                self.r, 'http://reddit.com/r/{}/comments/.json'.format(SUBREDDIT),
+                schedule=PollSchedule(max_interval=300, target=20))]
+        # the Mojang status doesn't change with the traffic, so it's checked every few minutes
+        self.status_interval = 60 * 3
+        self.status_next = 0
+        self.store = ModerationStore(DATABASEFILE + '.sqlite', legacy_path=DATABASEFILE)
+        self.blacklist = DomainBlacklist(self.r, SERVERDOMAINS)
+        self.blacklist.start()
+        self.filters = build_filters(self.r, self.imgur, self.y, self.store, self.blacklist)
+        self.regex_index = RegexIndex(self.filters)
+        self.routes = route_filters(self.filters)
+        # with a FilterPool, only these run in this process
+        self.local_routes = route_filters([i for i in self.filters if not i.text_only])
+        self.filter_pool = FilterPool(self.blacklist, processes) if processes else None
+        self.enrichment_filters = [i for i in self.filters if i.enriches()]
+        self.enrichment = EnrichmentQueue()
+        self.dispatcher = ActionDispatcher()
+        # how long a cycle waits for the enrichment filters before moving on, at most until the
+        # next poll is due; anything that finishes later is acted on next cycle
+        self.enrichment_wait = 60
+
+    def next_poll(self):
+        """The time.monotonic() at which something is next due to be read."""
+        return min([i.schedule.next for i in self.listings] + [self.status_next])
+
+    def due(self):
+        """The listings to read now, and whether to check the Mojang status."""
+        now = time.monotonic()
+        if now >= self.status_next:
+            self.status_next = now + self.status_interval
+            status = True
+        else:
+            status = False
+        return [i for i in self.listings if i.schedule.due(now)], status
+
+    def enrichment_timeout(self):
+        return max(0, min(self.enrichment_wait, self.next_poll() - time.monotonic()))
+
+    def update_status(self, status):
         p('Checking Mojang servers...', end='')
         if status:
-            if last_status:
-                if status != last_status:
+            if self.last_status:
+                if status != self.last_status:
                     p('Mojang server status changed, updating sidebar...', end='')
-                    r.sidebar(SUBREDDIT, status, SIDEBAR_TAGS)
-            last_status = status
+                    self.r.sidebar(SUBREDDIT, status, SIDEBAR_TAGS)
+            self.last_status = status
 
-        for i in (new_listing, modqueue_listing, comments_listing):
-            if i:
-                feed.extend(i['data']['children'])
+    def new_items(self, feed):
+        """Marks the unseen items in feed as seen and yields them."""
         for item in feed:
             item = item['data']
-            if item['name'] not in processed['ids']:
-                p('Processing {}'.format(item['id']), color_seed=item['name'], end="")
-                for f in filters:
-                    processed['ids'].append(item['name'])
-                    # Reddit's api is still a little weird here. Things are None if they're not
-                    # removed by anyone, but they're True if the spam filter removed it.
-                    # otherwise, it's the username of the mod.
-                    if item['banned_by'] is not None and item['banned_by'] is not True:
-                        break
-                    if item['author'] in (USERNAME, 'tweet_poster'):
-                        break
-                    if item['approved_by']:
-                        break
-                    if f.runFilter(item):
-                        if f.nuke:
-                            r.nuke(item, f.action)
-                        if f.comment:
-                            comment = {'thing_id': item['name'], 'text': f.comment}
-                            submission = r.post(
-                                'http://www.reddit.com/api/comment',
-                                comment)['json']['data']['things'][0]['data']['id']
-                            distinguish = {'id': submission, 'executed': 'distinguishing...'}
-                            r.post('http://www.reddit.com/api/distinguish/yes', distinguish)
-                        if f.report_subreddit:
-                            r.rts(
-                                item['author'], tag=f.tag, subreddit=f.report_subreddit,
-                                check_age=f.check_age)
-                        if f.ban and item['author'] not in processed['authors']:
-                            p(
-                                'Banning http://reddit.com/u/{}'.format(item['author']),
-                                color_seed=item['author'])
-                            body = {
-                                'action': 'add', 'type': 'banned', 'name': item['author'],
-                                'id': '#banned', 'r': item['subreddit']}
-                            r.post('http://www.reddit.com/api/friend', body)
-                            processed['authors'].append(item['author'])
-                        break
-        for i in range(sleep_time):
-            p('Next scan in {} seconds...'.format(sleep_time - i), end='')
-            time.sleep(1)
+            if item['name'] not in self.seen:
+                self.seen.add(item['name'])
+                yield item
+
+    def precheck(self, items):
+        """Drops the items the filters should leave alone, before any filter sees them."""
+        for item in items:
+            if self.ignored(item):
+                metrics.inc('moderator_items_total', kind=kind(item), result='ignored')
+            else:
+                metrics.inc('moderator_items_total', kind=kind(item), result='filtered')
+                yield item
+
+    def ignored(self, item):
+        """True for items the filters should leave alone."""
+        # Reddit's api is still a little weird here. Things are None if they're not
+        # removed by anyone, but they're True if the spam filter removed it.
+        # otherwise, it's the username of the mod.
+        if item['banned_by'] is not None and item['banned_by'] is not True:
+            return True
+        if item['author'] in (USERNAME, 'tweet_poster'):
+            return True
+        return bool(item['approved_by'])
+
+    def enrich(self, item):
+        """Nothing cheap caught item, so the slow filters get a look in the background."""
+        if 'title' in item and self.enrichment_filters:
+            self.enrichment.submit(item, self.enrichment_filters)
+
+    def evaluate(self, item):
+        """Runs the filters for its kind over item, which has been through precheck.  Returns
+        the Verdict of the filter that caught it, or None."""
+        p('Processing {}'.format(item['id']), color_seed=item['name'], end="")
+        with metrics.timer('moderator_filter_seconds', filter='RegexIndex', stage='scan'):
+            item['_scan'] = self.regex_index.scan(item)
+        for f in self.routes[kind(item)]:
+            verdict = f.runFilter(item)
+            if verdict:
+                return verdict
+        self.enrich(item)
+        return None
+
+    def evaluate_batch(self, items):
+        """Returns a Verdict or None for each of items, like evaluate.  With a FilterPool the
+        text-only filters run there for the whole batch, the rest run here and go first."""
+        if self.filter_pool is None:
+            return [self.evaluate(i) for i in items]
+        p('Processing {} items...'.format(len(items)), end='')
+        # the workers' own timings stay in the workers, so the pool is timed as one filter
+        with metrics.timer('moderator_filter_seconds', filter='FilterPool', stage='filter'):
+            found = self.filter_pool.check(items)
+        output = []
+        for item, verdict in zip(items, found):
+            for f in self.local_routes[kind(item)]:
+                local = f.runFilter(item)
+                if local:
+                    verdict = local
+                    break
+            else:
+                if verdict:
+                    metrics.inc(
+                        'moderator_filter_hits_total', filter=verdict.filter_name, stage='filter')
+                if verdict and verdict.log_text:
+                    logToDisk(verdict.log_text)
+            if not verdict:
+                self.enrich(item)
+            output.append(verdict)
+        return output
+
+    def _comment(self, item, text):
+        comment_id = self.r.comment(item, text)
+        return [Action('distinguish', comment_id, self.r.distinguish, comment_id)]
+
+    def _ban(self, item, filter_name):
+        self.r.ban(item['author'], item['subreddit'])
+        self.store.add_ban(item['author'], item['subreddit'], filter_name)
+
+    def act(self, item, verdict):
+        """Queues up what a filter decided about item, see dispatch."""
+        r = self.r
+        add = self.dispatcher.add
+        if verdict.nuke:
+            if verdict.action in ('remove', 'spammed'):
+                add(Action('remove', item['name'], r.remove, item, verdict.action))
+            elif verdict.action == 'report':
+                add(Action('report', item['name'], r.report, item))
+            if 'title' in item:
+                add(Action('hide', item['name'], r.hide, item))
+        if verdict.comment:
+            add(Action('comment', item['name'], self._comment, item, verdict.comment))
+        if verdict.report_subreddit:
+            add(Action(
+                'rts', item['author'], r.rts, item['author'], verdict.tag,
+                verdict.report_subreddit, verdict.check_age))
+        if verdict.ban and not self.store.is_banned(item['author'], item['subreddit']):
+            p(
+                'Banning http://reddit.com/u/{}'.format(item['author']),
+                color_seed=item['author'])
+            add(Action(
+                'ban', (item['author'], item['subreddit']), self._ban, item,
+                verdict.filter_name))
+
+    def dispatch(self):
+        """Carries out every action queued by act."""
+        succeeded, failed = self.dispatcher.run()
+        if failed:
+            p('{} moderation actions failed, {} went through'.format(failed, succeeded))
+
+    def report(self, start, since):
+        """Prints how long the cycle that started at `start` took, and where the time went."""
+        elapsed = time.perf_counter() - start
+        metrics.observe('moderator_cycle_seconds', elapsed)
+        summary = metrics.summary(since)
+        # the listing polled most often has to wait on the cycle
+        budget = min(i.schedule.interval for i in self.listings)
+        if budget and elapsed > budget:
+            p('Cycle took {:.1f}s, longer than the {:.0f}s between polls! {}'.format(
+                elapsed, budget, summary))
+        else:
+            p('Cycle took {:.1f}s. {}'.format(elapsed, summary).strip())
+
+    def poll(self):
+        """One blocking cycle: read the listings that are due and filter one item at a time, as
+        they come in.  With a FilterPool each listing is read in full and filtered as a batch."""
+        start, since = time.perf_counter(), metrics.snapshot()
+        listings, status = self.due()
+        if status:
+            self.update_status(mojangStatus())
+        p('Getting feed...', end='')
+        for listing in listings:
+            items = self.precheck(self.new_items(listing.stream()))
+            if self.filter_pool is None:
+                for item in items:
+                    verdict = self.evaluate(item)
+                    if verdict:
+                        self.act(item, verdict)
+            else:
+                items = list(items)
+                for item, verdict in zip(items, self.evaluate_batch(items)):
+                    if verdict:
+                        self.act(item, verdict)
+        self.dispatch()
+        for item, verdict in self.enrichment.results(self.enrichment_timeout()):
+            self.act(item, verdict)
+        self.dispatch()
+        self.store.commit()
+        self.seen.save()
+        action_log().render()
+        self.report(start, since)
+
+    async def poll_async(self, executor):
+        """One cycle with the due listings and the Mojang status fetched at the same time, and every
+        item filtered in its own task.  Filters don't keep any state per item, so a slow Imgur or
+        Youtube lookup no longer holds up the others.  Actions are queued afterwards, in feed
+        order, and dispatched together."""
+        loop = asyncio.get_running_loop()
+        start, since = time.perf_counter(), metrics.snapshot()
+        listings, status = self.due()
+        p('Getting feed...', end='')
+        fetches = [loop.run_in_executor(executor, i.fetch) for i in listings]
+        if status:
+            fetches.append(loop.run_in_executor(executor, mojangStatus))
+        results = await asyncio.gather(*fetches)
+        if status:
+            self.update_status(results.pop())
+        feed = []
+        for i in results:
+            feed.extend(i)
+        items = list(self.precheck(self.new_items(feed)))
+        if self.filter_pool is None:
+            verdicts = await asyncio.gather(
+                *[loop.run_in_executor(executor, self.evaluate, i) for i in items])
+        else:
+            verdicts = await loop.run_in_executor(executor, self.evaluate_batch, items)
+        for item, verdict in zip(items, verdicts):
+            if verdict:
+                self.act(item, verdict)
+        await loop.run_in_executor(executor, self.dispatch)
+        late = await loop.run_in_executor(
+            executor, self.enrichment.results, self.enrichment_timeout())
+        for item, verdict in late:
+            self.act(item, verdict)
+        await loop.run_in_executor(executor, self.dispatch)
+        self.store.commit()
+        self.seen.save()
+        action_log().render()
+        self.report(start, since)
+
+
+class ReplayTransport(object):
+    """Stands in for connection_pool when replaying a recorded corpus (see replay()).
+
+    The corpus directory holds the listings as reddit returned them (new.json, modqueue.json and
+    comments.json, newest first), responses.json with {url: {"status": ..., "body": ...}} for
+    anything else we'd fetch (imgur, youtube, user profiles...) and optionally domains.txt, the
+    server domain blacklist.  Listing items are let out oldest first by advance(), to play the
+    part of new posts arriving.  Every request is counted, and the time from an item being let
+    out to the first moderation call on it is kept in `latency`."""
+
+    def __init__(self, directory):
+        self.listings = {}
+        for name in ('new', 'modqueue', 'comments'):
+            try:
+                with open(os.path.join(directory, name + '.json')) as f:
+                    children = json.load(f)['data']['children']
+            except OSError:
+                children = []
+            self.listings[name] = list(reversed(children))
+        try:
+            with open(os.path.join(directory, 'responses.json')) as f:
+                self.responses = json.load(f)
+        except OSError:
+            self.responses = {}
+        try:
+            with open(os.path.join(directory, 'domains.txt')) as f:
+                self.domains = f.read()
+        except OSError:
+            self.domains = ''
+        self.revealed = {name: 0 for name in self.listings}
+        self.released = {}
+        self.acted = {}
+        self.latency = []
+        self.calls = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def advance(self, count):
+        """Lets out the next `count` items of every listing.  Returns how many came out."""
+        now = time.perf_counter()
+        output = 0
+        for name, children in self.listings.items():
+            start = self.revealed[name]
+            self.revealed[name] = min(len(children), start + count)
+            for i in children[start:self.revealed[name]]:
+                self.released.setdefault(i['data']['name'], now)
+            output += self.revealed[name] - start
+        return output
+
+    def _listing(self, name, query):
+        children = list(reversed(self.listings[name][:self.revealed[name]]))
+        names = [i['data']['name'] for i in children]
+        if 'before' in query:
+            end = names.index(query['before'][0]) if query['before'][0] in names else 0
+            children = children[:end]
+        elif 'after' in query:
+            start = names.index(query['after'][0]) + 1 if query['after'][0] in names else 0
+            children = children[start:]
+        children = children[:int(query.get('limit', ['25'])[0])]
+        return {'kind': 'Listing', 'data': {'children': children}}
+
+    def _reddit(self, method, path, query, form):
+        if method == 'POST':
+            if path.endswith('/api/login'):
+                return 200, {'json': {'data': {'modhash': 'replay'}}}
+            thing = (form.get('id') or form.get('thing_id') or [None])[0]
+            if thing and not path.endswith('/api/distinguish/yes'):
+                with self.lock:
+                    if thing in self.released and thing not in self.acted:
+                        self.acted[thing] = True
+                        self.latency.append(time.perf_counter() - self.released[thing])
+            if path.endswith('/api/comment'):
+                return 200, {'json': {'errors': [], 'data': {'things': [{'data': {'id': 'r'}}]}}}
+            return 200, {'json': {'errors': [], 'data': {'id': 'r', 'name': 't3_r'}}}
+        if path.startswith('/r/{}/wiki/replay-domains'.format(SUBREDDIT)):
+            return 200, {'data': {'content_md': self.domains, 'revision_id': 'replay'}}
+        if path.startswith('/r/{}/new'.format(SUBREDDIT)):
+            return 200, self._listing('new', query)
+        if path.startswith('/r/{}/about/modqueue'.format(SUBREDDIT)):
+            return 200, self._listing('modqueue', query)
+        if path.startswith('/r/{}/comments'.format(SUBREDDIT)):
+            return 200, self._listing('comments', query)
+        if path.startswith('/user/') and path.endswith('/about.json'):
+            # old enough not to be reported anywhere
+            return 200, {'data': {'created_utc': 0}}
+        if path.startswith('/user/'):
+            return 200, {'kind': 'Listing', 'data': {'children': []}}
+        return 404, {}
+
+    def send(self, method, url, body=None, headers=None):
+        parts = urlsplit(url)
+        host = '.'.join((parts.hostname or '').split('.')[-2:])
+        form = parse_qs(body.decode('utf-8')) if body else {}
+        endpoint = endpoint_name(url)
+        with self.lock:
+            self.calls[(method, host, endpoint)] += 1
+        recorded = self.responses.get(url) or self.responses.get(url.split('?')[0])
+        if recorded is not None:
+            status, data = recorded.get('status', 200), recorded.get('body')
+        elif url == STATUS_JSON:
+            status, data = 200, {'report': {
+                i: {'status': 'up', 'title': 'Online'}
+                for i in ('website', 'login', 'account', 'session', 'skins')}}
+        elif host == 'reddit.com':
+            status, data = self._reddit(method, parts.path, parse_qs(parts.query), form)
+        else:
+            status, data = 404, {}
+        headers = http.client.HTTPMessage()
+        headers['Content-Type'] = 'application/json'
+        if not isinstance(data, str):
+            data = json.dumps(data)
+        return status, 'Replayed', headers, data.encode('utf-8')
+
+
+def make_corpus(directory, count=2000, seed=0):
+    """Writes a synthetic corpus for replay() to directory: `count` submissions and comments
+    with some spam of every kind mixed in, plus the worst cases we know of, 10k line self-posts,
+    very long comments and a blacklist of thousands of domains."""
+    rand = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    words = (
+        'minecraft creeper redstone server world seed build castle survival mod texture pack '
+        'enderman diamond pickaxe nether portal village the a of and to my i it this').split()
+    domains = ['{}{}.net'.format(rand.choice(words), i) for i in range(5000)]
+    responses = {}
+
+    def text(n):
+        return ' '.join(rand.choice(words) for i in range(n))
+
+    def spam():
+        return rand.choice([
+            'join my server at {}'.format(rand.choice(domains)), 'ip: 98.12.{}.7 come play'.format(
+                rand.randint(0, 255)), 'free stuff bit.ly/{}'.format(rand.randint(0, 9999)),
+            'http://www.amazon.com/dp/B00?tag=mine-20', 'minecraftgiftcodes.com', 'u r drunk'])
+
+    submissions = []
+    comments = []
+    for i in range(count):
+        sub = {
+            'name': 't3_s{}'.format(i), 'id': 's{}'.format(i), 'title': text(8),
+            'selftext': '', 'url': 'http://reddit.com/r/{}/comments/s{}/'.format(SUBREDDIT, i),
+            'domain': 'self.{}'.format(SUBREDDIT), 'subreddit': SUBREDDIT,
+            'author': 'user{}'.format(rand.randint(0, count)), 'banned_by': None,
+            'approved_by': None, 'link_flair_css_class': 'pc', 'num_reports': 0}
+        kind = rand.random()
+        if kind < .3:
+            sub['selftext'] = '\n\n'.join(text(40) for j in range(rand.randint(1, 5)))
+        elif kind < .45:
+            image = ''.join(rand.choice('abcdefgABCDEFG0123456789') for j in range(7))
+            sub['url'], sub['domain'] = 'http://imgur.com/{}'.format(image), 'imgur.com'
+            responses['https://api.imgur.com/3/image/{}.json'.format(image)] = {'body': {'data': {
+                'title': text(5), 'description': spam() if rand.random() < .2 else text(20)}}}
+        elif kind < .55:
+            video = ''.join(rand.choice('abcdefgABCDEFG0123456789') for j in range(11))
+            sub['url'] = 'http://www.youtube.com/watch?v={}'.format(video)
+            sub['domain'] = 'youtube.com'
+            responses['http://gdata.youtube.com/feeds/api/videos/{}'.format(video)] = {'body': {
+                'entry': {
+                    'title': {'$t': text(6)}, 'author': [{'yt$userId': {'$t': 'channel'}}],
+                    'media$group': {'media$description': {
+                        '$t': spam() if rand.random() < .2 else text(30)}}}}}
+        else:
+            sub['url'] = 'http://example.com/{}'.format(i)
+            sub['domain'] = 'example.com'
+        if rand.random() < .05:
+            sub['selftext'] += ' ' + spam()
+        submissions.append({'kind': 't3', 'data': sub})
+        body = text(rand.randint(5, 60))
+        if rand.random() < .05:
+            body += ' ' + spam()
+        comments.append({'kind': 't1', 'data': {
+            'name': 't1_c{}'.format(i), 'id': 'c{}'.format(i), 'body': body,
+            'link_id': 't3_s{}'.format(rand.randint(0, count)), 'subreddit': SUBREDDIT,
+            'author': 'user{}'.format(rand.randint(0, count)), 'banned_by': None,
+            'approved_by': None, 'num_reports': 0}})
+    # the worst cases
+    for i in range(5):
+        submissions[rand.randrange(count)]['data']['selftext'] = '\n'.join(
+            text(12) for j in range(10000))
+        comments[rand.randrange(count)]['data']['body'] = text(5000)
+
+    def listing(children):
+        return {'kind': 'Listing', 'data': {'children': list(reversed(children))}}
+
+    modqueue = [i for i in submissions + comments if rand.random() < .02]
+    for name, children in (('new', submissions), ('comments', comments), ('modqueue', modqueue)):
+        with open(os.path.join(directory, name + '.json'), 'w') as f:
+            json.dump(listing(children), f)
+    with open(os.path.join(directory, 'responses.json'), 'w') as f:
+        json.dump(responses, f)
+    with open(os.path.join(directory, 'domains.txt'), 'w') as f:
+        f.write('\n'.join(domains))
+
+
+def replay(directory, batch=100):
+    """Runs the bot over a recorded corpus (see ReplayTransport) without touching the network,
+    `batch` new items per listing per cycle, and prints how fast it went."""
+    global connection_pool, DATABASEFILE, CACHEFILE, LOGFILE, SERVERDOMAINS, STATUS_JSON
+    workdir = tempfile.mkdtemp(prefix='moderator-bot-replay-')
+    DATABASEFILE = os.path.join(workdir, 'database')
+    CACHEFILE = os.path.join(workdir, 'cache')
+    LOGFILE = os.path.join(workdir, 'log.html')
+    SERVERDOMAINS = 'http://www.reddit.com/r/{}/wiki/replay-domains.json'.format(SUBREDDIT)
+    STATUS_JSON = 'http://status.replay/check.json'
+    transport = ReplayTransport(directory)
+    connection_pool = transport
+    # the simulated apis don't have a rate limit, and we want to see what we would send
+    for host in RATE_LIMITS:
+        RATE_LIMITS[host] = (10 ** 9, 1)
+    with _rate_limiters_lock:
+        _rate_limiters.clear()
+
+    bot = ModeratorBot()
+    # every cycle reads every listing, the scheduling isn't what's being measured
+    for listing in bot.listings:
+        listing.schedule.min_interval = listing.schedule.max_interval = 0
+    bot.status_interval = 0
+    # and waits for every lookup, like a quiet cycle would
+    bot.enrichment_timeout = lambda: bot.enrichment_wait
+    since = metrics.snapshot()
+    start = time.perf_counter()
+    while True:
+        released = transport.advance(batch)
+        bot.poll()
+        if not released:
+            break
+    elapsed = time.perf_counter() - start
+
+    # what happened to the items, going by the bot's own counters rather than what was let out,
+    # so items the bot never got to show up
+    results = defaultdict(int)
+    for (name, labels), value in metrics.snapshot()[0].items():
+        if name == 'moderator_items_total':
+            results[dict(labels)['result']] += value - since[0].get((name, labels), 0)
+    filtered = int(results['filtered'])
+    ignored = int(results['ignored'])
+    # the modqueue holds copies of items from the other listings, so count each one once
+    missed = len(transport.released) - filtered - ignored
+    print()
+    print('Filtered {} items in {:.2f}s, {:.1f} items/s'.format(
+        filtered, elapsed, filtered / elapsed if elapsed else 0))
+    print('{} items released, {} skipped by precheck, {} never reached a filter'.format(
+        len(transport.released), ignored, missed))
+    print('\nTime per filter:')
+    timings = []
+    for key, (total, calls) in metrics.snapshot()[1].items():
+        if key[0] == 'moderator_filter_seconds':
+            old_total, old_calls = since[1].get(key, (0, 0))
+            labels = dict(key[1])
+            timings.append((
+                '{} ({})'.format(labels['filter'], labels['stage']), calls - old_calls,
+                total - old_total))
+    for name, calls, total in sorted(timings, key=lambda i: -i[2]):
+        print('  {:<32} {:>8} calls {:>10.1f}ms {:>8.1f}us/call'.format(
+            name, calls, total * 1000, total / calls * 1e6 if calls else 0))
+    print('\nApi calls:')
+    for (method, host, endpoint), calls in sorted(transport.calls.items()):
+        print('  {:>6} {:<5} {:<14} {}'.format(calls, method, host, endpoint))
+    latency = sorted(transport.latency)
+    if latency:
+        print('\nItem arriving to first moderation call, {} items:'.format(len(latency)))
+        print('  mean {:.1f}ms, median {:.1f}ms, 95% {:.1f}ms, max {:.1f}ms'.format(
+            sum(latency) / len(latency) * 1000, latency[len(latency) // 2] * 1000,
+            latency[int(len(latency) * .95)] * 1000, latency[-1] * 1000))
+
+
+def countdown(bot):
+    """Returns how long to sleep until the bot has something to poll."""
+    sleep_time = max(0, bot.next_poll() - time.monotonic())
+    if sleep_time:
+        p('Next scan in {:.0f} seconds...'.format(sleep_time), end='')
+    return sleep_time
+
+
+async def main_async(bot, workers=8):
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            await bot.poll_async(executor)
+            await asyncio.sleep(countdown(bot))
+
+
+def main(use_async=False, processes=0, metrics_port=None):
+    if metrics_port:
+        metrics.serve(metrics_port)
+    bot = ModeratorBot(processes)
+    p('Started monitoring submissions on /r/{}.'.format(SUBREDDIT))
+
+    try:
+        if use_async:
+            asyncio.run(main_async(bot))
+        else:
+            # main loop
+            while True:
+                bot.poll()
+                time.sleep(countdown(bot))
+    finally:
+        bot.enrichment.close()
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Moderates /r/{}.'.format(SUBREDDIT))
+    parser.add_argument(
+        '--async', dest='use_async', action='store_true',
+        help='fetch listings and filter items concurrently')
+    parser.add_argument(
+        '--processes', type=int, default=0, metavar='N',
+        help='run the text filters on N worker processes (0 to use one process, the default)')
+    parser.add_argument(
+        '--metrics-port', type=int, metavar='PORT',
+        help='serve prometheus metrics at http://127.0.0.1:PORT/metrics')
+    parser.add_argument(
+        '--replay', metavar='DIR',
+        help='run over the recorded listings and responses in DIR instead of reddit, and report '
+             'how fast it went')
+    parser.add_argument(
+        '--replay-batch', type=int, default=100, metavar='N',
+        help='new items per listing per cycle when replaying (default 100)')
+    parser.add_argument(
+        '--make-corpus', metavar='DIR', help='write a synthetic corpus for --replay to DIR')
+    args = parser.parse_args()
     signal.signal(signal.SIGINT, sigint_handler)
-    main()
+    if args.make_corpus:
+        make_corpus(args.make_corpus)
+    elif args.replay:
+        replay(args.replay, args.replay_batch)
+    else:
+        main(
+            use_async=args.use_async, processes=args.processes, metrics_port=args.metrics_port)